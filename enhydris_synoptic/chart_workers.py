@@ -0,0 +1,36 @@
+"""Setup of the worker processes that plot the charts (see views.ChartRenderer).
+
+The worker processes are not forked from the process that renders the report, because
+forking a process that has other threads (e.g. a celery worker with --pool=threads)
+may leave the child with locks (of logging, of the font cache of matplotlib, of the
+database driver, and so on) that were held by these threads and will never be
+released. Instead, they are started by a "forkserver" process, and they set up Django
+themselves with initialize(). This module is what they import first, so it must not
+import anything that needs Django to be set up.
+"""
+import django
+from django.conf import settings
+
+# Modules that the forkserver process imports, so that the worker processes don't
+# have to
+PRELOADED_MODULES = ["matplotlib", "numpy", "pandas"]
+
+
+def get_settings():
+    """Return the settings that the worker processes need.
+
+    These are passed to initialize(), so that the worker processes have the same
+    settings as this process even if they have been changed at runtime (e.g. by
+    override_settings()).
+    """
+    return {
+        name: getattr(settings, name)
+        for name in dir(settings)
+        if name.startswith("ENHYDRIS_SYNOPTIC_") or name == "TEST_MATPLOTLIB"
+    }
+
+
+def initialize(worker_settings):
+    django.setup()
+    for name, value in worker_settings.items():
+        setattr(settings, name, value)
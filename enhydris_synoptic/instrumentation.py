@@ -0,0 +1,135 @@
+"""Measurement of the time and resources spent on rendering.
+
+The rendering code divides its work into measured blocks:
+
+    with measure("station", synoptic_group="ntua", station=1334):
+        with measure("page"):
+            ...
+
+For each block, the wall time, the CPU time of the current process, the number of
+SQL queries and the number of bytes written to files (which views.File reports with
+add_bytes_written()) are recorded. A block nested in another is included in the
+totals of the outer one and is also listed in its result. Blocks with labels (like
+"station" above) are units of work; they are logged when they finish and they are
+listed individually in the "children" of the enclosing block. Blocks without labels
+are stages; they are not logged, and they are aggregated by name in the "stages" of
+the enclosing block.
+
+The result of a block is a dictionary that can be serialized to JSON; it is
+available as the "result" attribute of the Measurement object after the block
+finishes, and it is also the "measurement" attribute of the log record.
+"""
+import logging
+import threading
+import time
+
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+METRICS = ("wall_time", "cpu_time", "queries", "bytes_written")
+
+_local = threading.local()
+
+
+def _get_active_measurements():
+    if not hasattr(_local, "measurements"):
+        _local.measurements = []
+    return _local.measurements
+
+
+def measure(name, **labels):
+    return Measurement(name, labels)
+
+
+def add_bytes_written(nbytes):
+    for measurement in _get_active_measurements():
+        measurement.bytes_written += nbytes
+
+
+def add_result(result):
+    """Add the result of a block measured elsewhere (e.g. in another process).
+
+    The result is added to the current block as if it had been nested in it. Its
+    bytes written are added to the totals of all active blocks; its time is not,
+    because it is not time of the current process.
+    """
+    add_bytes_written(result["bytes_written"])
+    _add_to_current_measurement(result)
+
+
+def _add_to_current_measurement(result):
+    active_measurements = _get_active_measurements()
+    if not active_measurements:
+        return
+    current = active_measurements[-1]
+    if result["labels"]:
+        current.children.append(result)
+    else:
+        _merge_stage(current.stages, result["name"], result)
+        current.children.extend(result["children"])
+
+
+def _merge_stage(stages, name, result):
+    stage = stages.setdefault(
+        name, {"count": 0, **{x: 0 for x in METRICS}, "stages": {}}
+    )
+    stage["count"] += result.get("count", 1)
+    for metric in METRICS:
+        stage[metric] += result[metric]
+    for substage_name, substage in result["stages"].items():
+        _merge_stage(stage["stages"], substage_name, substage)
+
+
+class Measurement:
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.queries = 0
+        self.bytes_written = 0
+        self.stages = {}
+        self.children = []
+
+    def __enter__(self):
+        self._query_counter = connection.execute_wrapper(self._count_query)
+        self._query_counter.__enter__()
+        _get_active_measurements().append(self)
+        self._start_wall_time = time.perf_counter()
+        self._start_cpu_time = time.process_time()
+        return self
+
+    def _count_query(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall_time = time.perf_counter() - self._start_wall_time
+        cpu_time = time.process_time() - self._start_cpu_time
+        _get_active_measurements().pop()
+        self._query_counter.__exit__(None, None, None)
+        self.result = {
+            "name": self.name,
+            "labels": self.labels,
+            "wall_time": wall_time,
+            "cpu_time": cpu_time,
+            "queries": self.queries,
+            "bytes_written": self.bytes_written,
+            "stages": self.stages,
+            "children": self.children,
+        }
+        if exc_type is None:
+            _add_to_current_measurement(self.result)
+            if self.labels:
+                self._log()
+
+    def _log(self):
+        logger.info(
+            "%s %s: %.3f s wall time, %.3f s CPU time, %d queries, %d bytes written",
+            self.name,
+            " ".join(f"{key}={value}" for key, value in self.labels.items()),
+            self.result["wall_time"],
+            self.result["cpu_time"],
+            self.result["queries"],
+            self.result["bytes_written"],
+            extra={"measurement": self.result},
+        )
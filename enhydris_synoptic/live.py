@@ -0,0 +1,154 @@
+"""Django views that render the synoptic report on request.
+
+This is an alternative to having create_static_files write static files; to use it,
+include "enhydris_synoptic.urls" in the URLconf. The group page, its stations.json,
+the station pages, their charts.json and the charts have the same URLs relative to
+one another as the static files, and they are rendered by the same code (see
+views.py).
+
+Each response has an ETag, made from the fingerprints of the stations (see
+SynopticGroupStation.fingerprint), and a Last-Modified header, which is the last
+common date, so that clients can make conditional requests. The responses, and
+their ETag and Last-Modified, are also cached for ENHYDRIS_SYNOPTIC_LIVE_CACHE_TIMEOUT
+seconds. The station pages, their charts.json and the charts load only the station
+they are about, not the entire synoptic group.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import Http404, HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+from .models import SynopticGroup, SynopticGroupStation
+from .views import (
+    Chart,
+    ChartPlot,
+    get_map_stations,
+    get_station_charts,
+    get_station_page,
+    get_synoptic_group_page,
+)
+
+
+def synoptic_group_page(request, slug):
+    def load():
+        sgroup = _get_synoptic_group(slug=slug)
+        return sgroup.synoptic_group_stations, lambda: get_synoptic_group_page(sgroup)
+
+    return _respond(request, f"group_{slug}", load, "text/html; charset=utf-8")
+
+
+def map_stations(request, slug):
+    def load():
+        sgroup = _get_synoptic_group(slug=slug)
+        return sgroup.synoptic_group_stations, lambda: get_map_stations(sgroup)
+
+    return _respond(request, f"stations_{slug}", load, "application/json")
+
+
+def station_page(request, slug, station_id):
+    def load():
+        synstation = _get_synoptic_group_station(
+            synoptic_group__slug=slug, station_id=station_id
+        )
+        return [synstation], lambda: get_station_page(synstation)
+
+    name = f"station_{slug}_{station_id}"
+    return _respond(request, name, load, "text/html; charset=utf-8")
+
+
+def station_charts(request, slug, station_id):
+    def load():
+        synstation = _get_synoptic_group_station(
+            synoptic_group__slug=slug, station_id=station_id
+        )
+        return [synstation], lambda: get_station_charts(synstation)
+
+    name = f"charts_{slug}_{station_id}"
+    return _respond(request, name, load, "application/json")
+
+
+def chart(request, synoptic_timeseries_group_id):
+    def load():
+        synstation = _get_synoptic_group_station(
+            synoptictimeseriesgroup__id=synoptic_timeseries_group_id
+        )
+        return [synstation], lambda: _get_chart_png(
+            synstation, synoptic_timeseries_group_id
+        )
+
+    return _respond(request, f"chart_{synoptic_timeseries_group_id}", load, "image/png")
+
+
+def _get_synoptic_group(**kwargs):
+    try:
+        return SynopticGroup.objects.for_rendering().get(**kwargs)
+    except SynopticGroup.DoesNotExist:
+        raise Http404
+
+
+def _get_synoptic_group_station(**kwargs):
+    try:
+        return SynopticGroupStation.objects.get_for_rendering(**kwargs)
+    except SynopticGroupStation.DoesNotExist:
+        raise Http404
+
+
+def _get_chart_png(synstation, synoptic_timeseries_group_id):
+    asyntsgs = synstation.synoptic_timeseries_groups
+    for asyntsg in asyntsgs:
+        if asyntsg.id == synoptic_timeseries_group_id:
+            return ChartPlot(Chart(asyntsg, asyntsgs).get_chart_data()).get_png()
+    # The station has no data, so there's no chart
+    raise Http404
+
+
+def _get_etag(synstations, name):
+    # "name" distinguishes the responses that depend on the same stations
+    fingerprints = [name] + [x.fingerprint for x in synstations]
+    return hashlib.sha256(" ".join(fingerprints).encode()).hexdigest()
+
+
+def _get_last_modified(synstations):
+    dates = [x.last_common_date for x in synstations if x.last_common_date]
+    return int(max(dates).timestamp()) if dates else None
+
+
+def _respond(request, name, load, content_type):
+    """Return the response, or a 304 response if the client has it already.
+
+    "name" identifies the response (e.g. "station_ntua_1334"). load() loads what
+    is needed and returns a tuple: the synoptic group stations on which the response
+    depends, and a function that returns the content. The ETag and Last-Modified are
+    cached for the same time as the content, so that usually nothing needs to be
+    loaded for a conditional request.
+    """
+    validators_key = f"enhydris_synoptic_live_validators_{name}"
+    validators = cache.get(validators_key)
+    loaded = None
+    if validators is None:
+        loaded = load()
+        synstations = loaded[0]
+        validators = (_get_etag(synstations, name), _get_last_modified(synstations))
+        cache.set(validators_key, validators, _get_cache_timeout())
+    etag, last_modified = validators
+    content_key = f"enhydris_synoptic_live_{etag}"
+    etag = quote_etag(etag)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        content = cache.get(content_key)
+        if content is None:
+            get_content = (loaded or load())[1]
+            content = get_content()
+            cache.set(content_key, content, _get_cache_timeout())
+        response = HttpResponse(content, content_type=content_type)
+    response["ETag"] = etag
+    if last_modified:
+        response["Last-Modified"] = http_date(last_modified)
+    return response
+
+
+def _get_cache_timeout():
+    return getattr(settings, "ENHYDRIS_SYNOPTIC_LIVE_CACHE_TIMEOUT", 60)
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.13 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("enhydris_synoptic", "0201_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="synopticgroupstation",
+            name="rendering_fingerprint",
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 3.2.13 on 2026-10-18 10:31
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("enhydris_synoptic", "0202_synopticgroupstation_rendering_fingerprint"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="EarlyWarningState",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "condition",
+                    models.CharField(
+                        choices=[
+                            ("low", "Lower than the low limit"),
+                            ("high", "Higher than the high limit"),
+                            ("rate_of_change", "Rate of change"),
+                        ],
+                        max_length=20,
+                    ),
+                ),
+                ("onset", models.DateTimeField()),
+                ("last_seen", models.DateTimeField()),
+                ("cleared", models.DateTimeField(blank=True, null=True)),
+                (
+                    "synoptic_timeseries_group",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="enhydris_synoptic.synoptictimeseriesgroup",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("synoptic_timeseries_group", "condition")},
+            },
+        ),
+    ]
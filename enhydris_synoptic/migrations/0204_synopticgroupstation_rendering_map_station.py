@@ -0,0 +1,18 @@
+# Generated by Django 3.2.13 on 2026-10-18 12:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("enhydris_synoptic", "0203_earlywarningstate"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="synopticgroupstation",
+            name="rendering_map_station",
+            field=models.TextField(blank=True, editable=False),
+        ),
+    ]
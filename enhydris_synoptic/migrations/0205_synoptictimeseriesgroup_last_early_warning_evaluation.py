@@ -0,0 +1,18 @@
+# Generated by Django 3.2.13 on 2026-10-18 14:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("enhydris_synoptic", "0204_synopticgroupstation_rendering_map_station"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="synoptictimeseriesgroup",
+            name="last_early_warning_evaluation",
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
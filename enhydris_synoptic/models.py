@@ -1,16 +1,42 @@
 import datetime as dt
+import hashlib
+import json
 import re
 from zoneinfo import ZoneInfo
 
 from django.conf import settings
-from django.core.mail import send_mail
-from django.db import DataError, IntegrityError, models
+from django.core.cache import caches
+from django.core.mail import EmailMessage
+from django.db import DataError, IntegrityError, models, transaction
+from django.db.models import OuterRef, Subquery, prefetch_related_objects
 from django.utils.translation import gettext as _
 
-import iso8601
-from rocc import Threshold, rocc
+from rocc import Threshold
 
-from enhydris.models import DISPLAY_TIMEZONE_CHOICES, Station, TimeseriesGroup
+from enhydris.models import (
+    DISPLAY_TIMEZONE_CHOICES,
+    Station,
+    Timeseries,
+    TimeseriesGroup,
+    TimeseriesRecord,
+)
+
+from .rate_of_change import ParsedThreshold, check_rate_of_change
+from .snapshot import StationSnapshot, SynopticTimeseriesGroupSnapshot, get_readings
+from .tail import tail_cache
+
+# The version of the rendering code and templates, which is part of the fingerprint
+# of the station pages. Increase it whenever a change in the code or the templates
+# changes the rendered station pages or charts, so that they are rendered again.
+RENDERING_VERSION = 3
+
+# The settings that affect the rendered station pages and charts.
+RENDERING_SETTINGS = (
+    "ENHYDRIS_SYNOPTIC_CHART_BACKEND",
+    "ENHYDRIS_SYNOPTIC_CHART_DOWNSAMPLING",
+    "ENHYDRIS_SYNOPTIC_PRECOMPRESS",
+    "ENHYDRIS_SYNOPTIC_STATION_LINK_TARGET",
+)
 
 # NOTE: Confusingly, there are three distinct uses of "group" here. They refer to
 # different things:
@@ -30,6 +56,24 @@ from enhydris.models import DISPLAY_TIMEZONE_CHOICES, Station, TimeseriesGroup
 # Yes, this sucks. Ideas on improving it are welcome.
 
 
+class SynopticGroupManager(models.Manager):
+    def for_rendering(self):
+        """Return synoptic groups with everything needed for rendering prefetched.
+
+        The stations, their synoptic time series groups, and the time series groups,
+        time series, units of measurement, rate-of-change thresholds and early warning
+        emails are loaded with a constant number of queries, regardless the number of
+        stations and variables.
+        """
+        return self.prefetch_related(
+            models.Prefetch(
+                "synopticgroupstation_set",
+                queryset=SynopticGroupStation.objects.for_rendering(),
+            ),
+            "earlywarningemail_set",
+        )
+
+
 class SynopticGroup(models.Model):
     name = models.CharField(max_length=50)
     slug = models.SlugField(unique=True, help_text="Identifier to be used in URL")
@@ -48,27 +92,257 @@ class SynopticGroup(models.Model):
         )
     )
 
+    objects = SynopticGroupManager()
+
     def __str__(self):
         return self.name
 
-    def queue_warning(self, asyntsg, warning_text):
+    @property
+    def synoptic_group_stations(self):
+        """List of the SynopticGroupStation objects of the group.
+
+        The list is created only once for each SynopticGroup instance. This way the
+        group page, the station pages, the charts and the early warnings all use the
+        same objects, and the data of each station is read only once.
+        """
+        if not hasattr(self, "_synoptic_group_stations"):
+            self._synoptic_group_stations = list(self.synopticgroupstation_set.all())
+        return self._synoptic_group_stations
+
+    def load_synoptic_group_stations(self, synoptic_group_station_ids):
+        """Load only some stations of the group, with what is needed for rendering.
+
+        Afterwards synoptic_group_stations contains only these stations, so that
+        last_common_dates and end_dates, as well as the data read, cover only them.
+        """
+        synstations = list(
+            SynopticGroupStation.objects.for_rendering().filter(
+                synoptic_group=self, id__in=synoptic_group_station_ids
+            )
+        )
+        for synstation in synstations:
+            synstation.synoptic_group = self
+        self._synoptic_group_stations = synstations
+
+    @property
+    def last_common_dates(self):
+        """Dictionary mapping each SynopticGroupStation id to its last common date.
+
+        The last common dates of all the stations of the group are determined at once,
+        with a constant number of queries regardless the number of stations and time
+        series. Stations without any time series (or without any data) map to None.
+        """
+        if not hasattr(self, "_last_common_dates"):
+            self._determine_last_common_dates()
+        return self._last_common_dates
+
+    @property
+    def end_dates(self):
+        """Dictionary mapping the ids of the default time series to their end date.
+
+        This covers the default time series of all the synoptic time series groups of
+        the group; it is determined together with last_common_dates.
+        """
+        if not hasattr(self, "_end_dates"):
+            self._determine_last_common_dates()
+        return self._end_dates
+
+    def _determine_last_common_dates(self):
+        # We don't actually get the last common date, which would be difficult;
+        # instead, we get the minimum of the last dates of the timeseries, which will
+        # usually be the last common date.
+        # prefetch_related_objects() does nothing for whatever has already been
+        # prefetched (e.g. by SynopticGroup.objects.for_rendering()).
+        prefetch_related_objects(
+            self.synoptic_group_stations,
+            "synoptictimeseriesgroup_set__timeseries_group__timeseries_set",
+            "synoptictimeseriesgroup_set__timeseries_group__gentity",
+        )
+        synoptic_timeseries_groups = [
+            asyntsg
+            for sgs in self.synoptic_group_stations
+            for asyntsg in sgs.synoptictimeseriesgroup_set.all()
+        ]
+        self._end_dates = end_dates = self._get_end_dates(
+            [x.default_timeseries for x in synoptic_timeseries_groups]
+        )
+        self._last_common_dates = {}
+        for asyntsg in synoptic_timeseries_groups:
+            sgs_id = asyntsg.synoptic_group_station_id
+            last_common_date = self._last_common_dates.get(sgs_id)
+            end_date = asyntsg.default_timeseries and end_dates.get(
+                asyntsg.default_timeseries.id
+            )
+            if end_date and ((not last_common_date) or (end_date < last_common_date)):
+                last_common_date = end_date.astimezone(
+                    ZoneInfo(asyntsg.timeseries_group.gentity.display_timezone)
+                )
+            self._last_common_dates[sgs_id] = last_common_date
+
+    def _get_end_dates(self, timeseries):
+        """Return a dictionary mapping the ids of the time series to their end date.
+
+        Time series without records are omitted. The end date of each time series is
+        its last timestamp, which is found with a subquery that uses the index on
+        (timeseries, timestamp), so the time needed does not depend on the length of
+        the time series (whereas an aggregate grouped by time series would read all
+        their records).
+        """
+        last_timestamp = (
+            TimeseriesRecord.objects.filter(timeseries_id=OuterRef("id"))
+            .order_by("-timestamp")
+            .values("timestamp")[:1]
+        )
+        end_dates = (
+            Timeseries.objects.filter(id__in=[x.id for x in timeseries if x])
+            .annotate(end_date=Subquery(last_timestamp))
+            .values_list("id", "end_date")
+        )
+        return {
+            timeseries_id: end_date
+            for timeseries_id, end_date in end_dates
+            if end_date is not None
+        }
+
+    def record_early_warning_evaluation(self, station_name, asyntsg, warnings, date):
+        """Record the early warnings of a synoptic time series group at date.
+
+        "warnings" is a dict with the early warning texts, by condition. The
+        evaluations are stored in the early_warning_evaluations dict, by the id of the
+        synoptic time series group (as a string, so that the dict can be sent between
+        celery tasks), until update_early_warning_states() processes them.
+        """
+        if not hasattr(self, "early_warning_evaluations"):
+            self.early_warning_evaluations = {}
+        self.early_warning_evaluations[str(asyntsg.id)] = {
+            "synoptic_timeseries_group": asyntsg.id,
+            "date": date.isoformat(),
+            "station": station_name,
+            "variable": asyntsg.get_title(),
+            "warnings": warnings,
+        }
+
+    def check_early_warnings(self):
+        """Evaluate the early warnings of all stations.
+
+        This only reads the data needed for the checks (see
+        SynopticGroupStation.evaluate_early_warnings()); it does not render anything.
+        Afterwards, send_early_warning_emails() can update the states and email the
+        warnings that start or end.
+        """
+        for synstation in self.synoptic_group_stations:
+            synstation.evaluate_early_warnings()
+
+    def update_early_warning_states(self):
+        """Update the early warning states from the recorded evaluations.
+
+        The warnings that start or end (see EarlyWarningState) are queued for sending;
+        the ones that continue are not. An evaluation of a synoptic time series group
+        is ignored if its date is not later than the last update of the states of the
+        group or than its last processed evaluation, since nothing can have changed
+        without new data.
+        """
+        evaluations = getattr(self, "early_warning_evaluations", {})
+        asyntsg_ids = [int(x) for x in evaluations]
+        states = {}
+        for state in EarlyWarningState.objects.filter(
+            synoptic_timeseries_group_id__in=asyntsg_ids
+        ):
+            states.setdefault(state.synoptic_timeseries_group_id, {})
+            states[state.synoptic_timeseries_group_id][state.condition] = state
+        last_evaluations = dict(
+            SynopticTimeseriesGroup.objects.filter(id__in=asyntsg_ids).values_list(
+                "id", "last_early_warning_evaluation"
+            )
+        )
+        for evaluation in evaluations.values():
+            asyntsg_id = evaluation["synoptic_timeseries_group"]
+            self._update_early_warning_states_of_synoptic_timeseries_group(
+                evaluation, states.get(asyntsg_id, {}), last_evaluations.get(asyntsg_id)
+            )
+
+    def _update_early_warning_states_of_synoptic_timeseries_group(
+        self, evaluation, states, last_evaluation
+    ):
+        date = dt.datetime.fromisoformat(evaluation["date"])
+        last_updated = [x.last_updated for x in states.values()]
+        if last_evaluation is not None:
+            last_updated.append(last_evaluation)
+        if last_updated and date <= max(last_updated):
+            return
+        SynopticTimeseriesGroup.objects.filter(
+            id=evaluation["synoptic_timeseries_group"]
+        ).update(last_early_warning_evaluation=date)
+        for condition, warning_text in evaluation["warnings"].items():
+            state = states.get(condition) or EarlyWarningState(
+                synoptic_timeseries_group_id=evaluation["synoptic_timeseries_group"],
+                condition=condition,
+            )
+            if state.pk is None or state.cleared is not None:
+                state.onset = date
+                state.cleared = None
+                self.queue_warning(evaluation, condition, warning_text)
+            state.last_seen = date
+            state.save()
+        for condition, state in states.items():
+            if state.cleared is None and condition not in evaluation["warnings"]:
+                state.cleared = date
+                state.save()
+                timestr = date.replace(tzinfo=None).isoformat(
+                    sep=" ", timespec="minutes"
+                )
+                warning_text = f"{timestr} " + _("back to normal")
+                self.queue_warning(evaluation, condition, warning_text)
+
+    def queue_warning(self, evaluation, condition, warning_text):
         if not hasattr(self, "early_warnings"):
             self.early_warnings = {}
-        self.early_warnings[asyntsg.get_title()] = {
-            "station": asyntsg.synoptic_group_station.station.name,
-            "variable": asyntsg.get_title(),
+        key = f"{evaluation['synoptic_timeseries_group']} {condition}"
+        self.early_warnings[key] = {
+            "station": evaluation["station"],
+            "variable": evaluation["variable"],
             "warning_text": warning_text,
         }
 
-    def send_early_warning_emails(self):
+    def send_early_warning_emails(self, connection=None):
+        """Update the early warning states and email the warnings that start or end.
+
+        This is done in a transaction that locks the synoptic group, so concurrent
+        evaluations of the group (e.g. by create_static_files and
+        check_early_warnings) are processed one after the other, and a warning is
+        not emailed twice. The transaction is committed after the email is sent; if
+        sending fails, the states remain as they were, and the warnings will be
+        emailed next time.
+
+        If "connection" (a connection to the mail server) is specified, it is opened
+        if needed, but it is not closed, so that it can be used for more emails.
+        """
+        with transaction.atomic():
+            SynopticGroup.objects.select_for_update().get(id=self.id)
+            self.update_early_warning_states()
+            message = self.get_early_warning_email()
+            if message is None:
+                return
+            if connection is not None:
+                connection.open()
+            message.connection = connection
+            message.send()
+
+    def get_early_warning_email(self):
+        """Return the email with the queued early warnings as an EmailMessage.
+
+        Returns None if there are no early warnings or nowhere to send them.
+        """
         if len(getattr(self, "early_warnings", {})) == 0:
-            return
+            return None
         emails = [x.email for x in self.earlywarningemail_set.all()]
+        if not emails:
+            return None
         content = ""
         for var in self.early_warnings:
             content += self._get_early_warning_text(self.early_warnings[var])
         subject = self._get_warning_email_subject()
-        send_mail(subject, content, settings.DEFAULT_FROM_EMAIL, emails)
+        return EmailMessage(subject, content, settings.DEFAULT_FROM_EMAIL, emails)
 
     def _get_warning_email_subject(self):
         stations = list({v["station"] for k, v in self.early_warnings.items()})
@@ -92,6 +366,46 @@ class EarlyWarningEmail(models.Model):
         verbose_name_plural = _("Where to send early warnings")
 
 
+class SynopticGroupStationManager(models.Manager):
+    def for_rendering(self):
+        """Return synoptic group stations with what is needed for rendering.
+
+        The stations and the synoptic time series groups (see
+        SynopticTimeseriesGroup.objects.for_rendering()) are also loaded.
+        """
+        return self.select_related("station").prefetch_related(
+            models.Prefetch(
+                "synoptictimeseriesgroup_set",
+                queryset=SynopticTimeseriesGroup.objects.for_rendering(),
+            )
+        )
+
+    def get_for_rendering(self, **kwargs):
+        """Return a single synoptic group station with what is needed for rendering.
+
+        This is for rendering a single station (e.g. its page), without loading the
+        rest of its synoptic group. The synoptic_group_stations of the returned
+        object's synoptic group contains only that object, so that only the data of
+        that station is read.
+        """
+        synstation = self.for_rendering().select_related("synoptic_group").get(**kwargs)
+        synstation.synoptic_group._synoptic_group_stations = [synstation]
+        return synstation
+
+    def get_rendered_map_stations(self, ids):
+        """Return the stations.json entries stored when the stations were rendered.
+
+        These are the rendering_map_station of the synoptic group stations with the
+        specified ids, in order; stations that have never been rendered are omitted.
+        """
+        serialized_map_stations = (
+            self.filter(id__in=ids)
+            .exclude(rendering_map_station="")
+            .values_list("rendering_map_station", flat=True)
+        )
+        return [json.loads(x) for x in serialized_map_stations]
+
+
 class SynopticGroupStation(models.Model):
     synoptic_group = models.ForeignKey(SynopticGroup, on_delete=models.CASCADE)
     station = models.ForeignKey(Station, on_delete=models.CASCADE)
@@ -99,6 +413,10 @@ class SynopticGroupStation(models.Model):
     timeseries_groups = models.ManyToManyField(
         TimeseriesGroup, through="SynopticTimeseriesGroup"
     )
+    rendering_fingerprint = models.CharField(max_length=64, blank=True, editable=False)
+    rendering_map_station = models.TextField(blank=True, editable=False)
+
+    objects = SynopticGroupStationManager()
 
     class Meta:
         unique_together = (("synoptic_group", "order"),)
@@ -107,6 +425,67 @@ class SynopticGroupStation(models.Model):
     def __str__(self):
         return str(self.station)
 
+    @property
+    def fingerprint(self):
+        """A hash of whatever the station page and charts depend on.
+
+        This consists of the end dates of the default time series, the configuration
+        of the station and its synoptic time series groups, the settings that affect
+        the rendering, RENDERING_VERSION, and the freshness. If it is the same as
+        rendering_fingerprint, which is the fingerprint at the time the station was
+        last rendered, the station need not be rendered again.
+        """
+        end_dates = self.synoptic_group.end_dates
+        items = [self.freshness, self._get_configuration()]
+        for asyntsg in self.synoptictimeseriesgroup_set.all():
+            default_timeseries = asyntsg.default_timeseries
+            end_date = default_timeseries and end_dates.get(default_timeseries.id)
+            items.append(end_date and end_date.isoformat())
+        serialized_items = json.dumps(items, default=str).encode()
+        return hashlib.sha256(serialized_items).hexdigest()
+
+    def _get_configuration(self):
+        sgroup = self.synoptic_group
+        station = self.station
+        result = [RENDERING_VERSION, sgroup.slug, sgroup.name, sgroup.timezone]
+        result.append([station.name, station.geom and station.geom.ewkt])
+        result.append([getattr(settings, name, None) for name in RENDERING_SETTINGS])
+        for asyntsg in self.synoptictimeseriesgroup_set.all():
+            result.append(
+                [getattr(asyntsg, f.attname) for f in asyntsg._meta.concrete_fields]
+            )
+            result.append(asyntsg.get_roc_thresholds_as_text())
+            timeseries_group = asyntsg.timeseries_group
+            result.append(
+                [
+                    timeseries_group.get_name(),
+                    timeseries_group.precision,
+                    timeseries_group.unit_of_measurement.symbol,
+                ]
+            )
+        return result
+
+    def save_rendering_fingerprint(self, fingerprint, map_station):
+        """Save the fingerprint and the stations.json entry of the rendered station.
+
+        The entry is stored as JSON in rendering_map_station, so that, as long as the
+        fingerprint remains the same, it can be used without reading the data.
+        """
+        serialized_map_station = json.dumps(map_station, ensure_ascii=False)
+        SynopticGroupStation.objects.filter(id=self.id).update(
+            rendering_fingerprint=fingerprint,
+            rendering_map_station=serialized_map_station,
+        )
+        self.rendering_fingerprint = fingerprint
+        self.rendering_map_station = serialized_map_station
+
+    @property
+    def primary_synoptic_timeseries_groups(self):
+        """List of the synoptic timeseries groups that don't have group_with."""
+        return [
+            x for x in self.synoptictimeseriesgroup_set.all() if x.group_with_id is None
+        ]
+
     def check_timeseries_groups_integrity(self, *args, **kwargs):
         """
         This method checks whether the timeseries_groups.through.order field starts with
@@ -142,104 +521,208 @@ class SynopticGroupStation(models.Model):
 
         super(SynopticGroupStation, self).save(*args, **kwargs)
 
+    @property
+    def snapshot(self):
+        """The StationSnapshot of the station (see the "snapshot" module)."""
+        if not hasattr(self, "_snapshot"):
+            self._snapshot = self._get_snapshot()
+        return self._snapshot
+
     @property
     def synoptic_timeseries_groups(self):
-        """List of synoptic timeseries group objects with data.
+        """List of SynopticTimeseriesGroupSnapshot objects, one per time series group.
 
-        The objects in the list have attribute "data", which is a pandas dataframe with
-        the last 24 hours preceding the last common date, "value", which is the
-        value at the last common date, and "value_status" which is the string "ok",
-        "high" or "low", depending on where "value" is compared to low_limit and
-        high_limit.
+        These have the data of the last 24 hours preceding the last common date, the
+        value at the last common date, its status ("ok", "high", "low" or "error") and
+        the early warnings (see the "snapshot" module).
         """
-        if not hasattr(self, "_synoptic_timeseries_groups"):
-            self._determine_timeseries_groups()
-        return self._synoptic_timeseries_groups
+        return self.snapshot.timeseries_groups
 
-    def _determine_timeseries_groups(self):
+    @property
+    def error(self):
+        return self.snapshot.error
+
+    def _get_snapshot(self):
         if self.last_common_date is None:
-            self._synoptic_timeseries_groups = []
+            return StationSnapshot(error=False, timeseries_groups=[])
+        asyntsgs = list(self.synoptictimeseriesgroup_set.all())
+        readings = self._get_readings(asyntsgs)
+        snapshot = StationSnapshot(
+            error=readings["error"],
+            timeseries_groups=[
+                SynopticTimeseriesGroupSnapshot(asyntsg, tsg_readings)
+                for asyntsg, tsg_readings in zip(
+                    asyntsgs, readings["timeseries_groups"]
+                )
+            ],
+        )
+        for asyntsg, tsg_snapshot in zip(asyntsgs, snapshot.timeseries_groups):
+            if tsg_snapshot.value_status != "error":
+                self.synoptic_group.record_early_warning_evaluation(
+                    self.station.name,
+                    asyntsg,
+                    tsg_snapshot.warnings,
+                    self.last_common_date,
+                )
+        return snapshot
+
+    def evaluate_early_warnings(self):
+        """Evaluate the early warnings of the station, without the data of the charts.
+
+        The evaluations are recorded in the synoptic group, as when the snapshot is
+        computed, but only the records needed for the checks are read: those of the
+        rate-of-change window, which ends at the last common date and is usually much
+        shorter than the 24 hours of the charts. Time series groups whose last
+        processed evaluation is not earlier than the last common date are skipped
+        without reading anything, since their early warnings cannot have changed. If
+        the snapshot has been computed, the evaluations have already been recorded,
+        and nothing is done.
+        """
+        if hasattr(self, "_snapshot") or self.last_common_date is None:
             return
-        start_date = self.last_common_date - dt.timedelta(minutes=1439)
-        self._synoptic_timeseries_groups = list(self.synoptictimeseriesgroup_set.all())
-        self.error = False  # This may be changed by _set_ts_value()
-        for asyntsg in self._synoptic_timeseries_groups:
-            asyntsg.data = asyntsg.timeseries_group.default_timeseries.get_data(
-                start_date=start_date, end_date=self.last_common_date
-            ).data
-            self._set_tsg_value(asyntsg)
-            self._set_tsg_value_status(asyntsg)
-
-    def _set_tsg_value(self, asyntsg):
-        try:
-            asyntsg.value = asyntsg.data.loc[self.last_common_date]["value"]
-        except KeyError:
-            self.error = True
-
-    def _set_tsg_value_status(self, asyntsg):
-        if not hasattr(asyntsg, "value") or asyntsg.value is None:
-            asyntsg.value_status = "error"
-        elif asyntsg.low_limit is not None and asyntsg.value < asyntsg.low_limit:
-            asyntsg.value_status = "low"
-            self.synoptic_group.queue_warning(
-                asyntsg,
-                self._out_of_limits_message(asyntsg, f"low limit {asyntsg.low_limit}"),
+        for asyntsg in self.synoptictimeseriesgroup_set.all():
+            last_evaluation = asyntsg.last_early_warning_evaluation
+            if last_evaluation is not None and self.last_common_date <= last_evaluation:
+                continue
+            roc_data = tail_cache.read(
+                asyntsg.default_timeseries,
+                start_date=self.last_common_date - asyntsg.roc_timedelta,
+                end_date=self.last_common_date,
+                timezone=asyntsg.timeseries_group.gentity.display_timezone,
+            )
+            try:
+                value = roc_data.loc[self.last_common_date]["value"]
+            except KeyError:
+                # As in the snapshot, where the value status is then "error"
+                continue
+            _, warnings = self._check_tsg_value(asyntsg, value, roc_data)
+            self.synoptic_group.record_early_warning_evaluation(
+                self.station.name, asyntsg, warnings, self.last_common_date
+            )
+
+    # The "readings" of a station are what _compute_readings() computes: the data,
+    # value, value status and early warnings of each synoptic time series group. They
+    # depend only on the time series, their end dates and the limits and thresholds,
+    # so if ENHYDRIS_SYNOPTIC_SNAPSHOT_CACHE is set, they are stored in that Django
+    # cache under a key made of these, and they are reused by other synoptic groups
+    # that have the same station, by other workers, and by later runs.
+    def _get_readings(self, asyntsgs):
+        snapshot_cache = _get_snapshot_cache()
+        if snapshot_cache is None:
+            return self._compute_readings(asyntsgs)
+        key = self._get_snapshot_key(asyntsgs)
+        readings = snapshot_cache.get(key)
+        if readings is None:
+            readings = self._compute_readings(asyntsgs)
+            snapshot_cache.set(key, readings, _get_snapshot_cache_timeout())
+        return readings
+
+    def _get_snapshot_key(self, asyntsgs):
+        end_dates = self.synoptic_group.end_dates
+        items = [self.last_common_date.isoformat()]
+        for asyntsg in asyntsgs:
+            default_timeseries = asyntsg.default_timeseries
+            end_date = default_timeseries and end_dates.get(default_timeseries.id)
+            items.append(
+                [
+                    default_timeseries and default_timeseries.id,
+                    end_date and end_date.isoformat(),
+                    asyntsg.timeseries_group.gentity.display_timezone,
+                    asyntsg.low_limit,
+                    asyntsg.high_limit,
+                    asyntsg.get_roc_thresholds_as_text(),
+                    asyntsg.symmetric_rocc,
+                ]
+            )
+        serialized_items = json.dumps(items, default=str).encode()
+        # The prefix differs from that of older versions, which cached dataframes
+        return (
+            "enhydris_synoptic_readings_" + hashlib.sha256(serialized_items).hexdigest()
+        )
+
+    def _compute_readings(self, asyntsgs):
+        error = False
+        timeseries_groups = []
+        for asyntsg in asyntsgs:
+            data, roc_data = self._read_tsg_data(asyntsg)
+            try:
+                value = data.loc[self.last_common_date]["value"]
+            except KeyError:
+                error = True
+                value = None
+            value_status, warnings = self._check_tsg_value(asyntsg, value, roc_data)
+            timeseries_groups.append(get_readings(data, value, value_status, warnings))
+        return {"error": error, "timeseries_groups": timeseries_groups}
+
+    def _read_tsg_data(self, asyntsg):
+        """Return the data for the chart and the data for the rate-of-change check.
+
+        We read the data once, covering both the last 24 hours (needed for the chart)
+        and the rate-of-change window (needed for the rate-of-change check), and slice
+        it in memory for each of the two uses. Only these records are read from the
+        database, and they are shared with other synoptic groups that have the same
+        station (see the "tail" module).
+        """
+        chart_start_date = self.last_common_date - dt.timedelta(minutes=1439)
+        roc_start_date = self.last_common_date - asyntsg.roc_timedelta
+        data = tail_cache.read(
+            asyntsg.default_timeseries,
+            start_date=min(chart_start_date, roc_start_date),
+            end_date=self.last_common_date,
+            timezone=asyntsg.timeseries_group.gentity.display_timezone,
+        )
+        return data.loc[chart_start_date:], data.loc[roc_start_date:]
+
+    def _check_tsg_value(self, asyntsg, value, roc_data):
+        """Return the value status and the early warnings of a time series group."""
+        warnings = {}
+        if value is None:
+            value_status = "error"
+        elif asyntsg.low_limit is not None and value < asyntsg.low_limit:
+            value_status = "low"
+            warnings["low"] = self._out_of_limits_message(
+                value, f"low limit {asyntsg.low_limit}"
             )
-        elif asyntsg.high_limit is not None and asyntsg.value > asyntsg.high_limit:
-            asyntsg.value_status = "high"
-            clarif = f"high limit {asyntsg.high_limit}"
-            self.synoptic_group.queue_warning(
-                asyntsg, self._out_of_limits_message(asyntsg, clarif)
+        elif asyntsg.high_limit is not None and value > asyntsg.high_limit:
+            value_status = "high"
+            warnings["high"] = self._out_of_limits_message(
+                value, f"high limit {asyntsg.high_limit}"
             )
         else:
-            asyntsg.value_status = "ok"
+            value_status = "ok"
 
-        check_rate_of_change_results = self._check_rate_of_change(asyntsg)
-        if check_rate_of_change_results:
+        rate_of_change_failure = self._check_rate_of_change(asyntsg, roc_data)
+        if rate_of_change_failure:
             # For the time being we don't set the status here, we just send a warning.
-            self.synoptic_group.queue_warning(asyntsg, check_rate_of_change_results)
+            warnings["rate_of_change"] = self._rate_of_change_message(
+                rate_of_change_failure
+            )
+        return value_status, warnings
 
-    def _out_of_limits_message(self, asyntsg, clarification):
+    def _out_of_limits_message(self, value, clarification):
         timestr = self.last_common_date.replace(tzinfo=None).isoformat(
             sep=" ", timespec="minutes"
         )
-        return f"{timestr} {asyntsg.value} ({clarification})"
+        return f"{timestr} {value} ({clarification})"
 
-    def _check_rate_of_change(self, asyntsg):
-        start_date = self.last_common_date - self._get_roc_timedelta(asyntsg)
-        timeseries = asyntsg.timeseries_group.default_timeseries.get_data(
-            start_date=start_date, end_date=self.last_common_date
-        )
-        messages = rocc(
-            timeseries=timeseries,
-            thresholds=asyntsg.roc_thresholds,
+    def _check_rate_of_change(self, asyntsg, roc_data):
+        return check_rate_of_change(
+            roc_data,
+            self.last_common_date,
+            thresholds=asyntsg.parsed_roc_thresholds,
             symmetric=asyntsg.symmetric_rocc,
-            flag="",
         )
-        if not messages:
-            return None
-        message = messages[-1]
-        date = iso8601.parse_date(message.split()[0]).replace(tzinfo=None)
-        if date == self.last_common_date.replace(tzinfo=None):
-            return message
-
-    def _get_roc_timedelta(self, asyntsg):
-        roc_timedeltas = [
-            self._parse_timedelta(x.split()[0])
-            for x in asyntsg.get_roc_thresholds_as_text().splitlines()
-        ]
-        if roc_timedeltas:
-            return max(roc_timedeltas)
-        else:
-            return dt.timedelta(0)
 
-    def _parse_timedelta(self, stepspec):
-        if stepspec.endswith("min"):
-            return dt.timedelta(minutes=int(stepspec[:-3]))
-        elif stepspec[-1] == "H":
-            return dt.timedelta(hours=int(stepspec[:-1]))
-        elif stepspec[-1] == "D":
-            return dt.timedelta(days=int(stepspec[:-1]))
+    def _rate_of_change_message(self, failure):
+        # Same format as the messages of rocc()
+        timestr = failure.timestamp.replace(tzinfo=None).isoformat(timespec="minutes")
+        diffsign = "+" if failure.diff > 0 else ""
+        thresholdsign = "-" if failure.diff < 0 else ""
+        cmpsign = ">" if failure.diff > 0 else "<"
+        return (
+            f"{timestr}  {diffsign}{failure.diff} in {failure.threshold.delta_t_text} "
+            f"({cmpsign} {thresholdsign}{abs(failure.threshold.allowed_diff)})"
+        )
 
     @property
     def last_common_date(self):
@@ -248,15 +731,9 @@ class SynopticGroupStation(models.Model):
         return self._last_common_date
 
     def _determine_last_common_date(self):
-        # We don't actually get the last common date, which would be difficult; instead,
-        # we get the minimum of the last dates of the timeseries, which will usually be
-        # the last common date. station is an enhydris_synoptic.models.Station object.
-        last_common_date = None
-        for asyntsg in self.synoptictimeseriesgroup_set.all():
-            end_date = asyntsg.timeseries_group.default_timeseries.end_date
-            if end_date and ((not last_common_date) or (end_date < last_common_date)):
-                last_common_date = end_date
-        self._last_common_date = last_common_date
+        # This is determined for all stations of the synoptic group at once; see
+        # SynopticGroup.last_common_dates.
+        self._last_common_date = self.synoptic_group.last_common_dates.get(self.id)
 
     @property
     def last_common_date_pretty(self):
@@ -288,11 +765,35 @@ class SynopticGroupStation(models.Model):
         return target.format(station=self.station)
 
 
+def _get_snapshot_cache():
+    alias = getattr(settings, "ENHYDRIS_SYNOPTIC_SNAPSHOT_CACHE", None)
+    return caches[alias] if alias else None
+
+
+def _get_snapshot_cache_timeout():
+    return getattr(settings, "ENHYDRIS_SYNOPTIC_SNAPSHOT_CACHE_TIMEOUT", 86400)
+
+
 class SynopticTimeseriesGroupManager(models.Manager):
     def primary(self):
         """Return only time series groups that don't have group_with."""
         return self.filter(group_with__isnull=True)
 
+    def for_rendering(self):
+        """Return synoptic time series groups with what is needed for rendering.
+
+        The time series groups, their time series, units of measurement and
+        variables, and the rate-of-change thresholds are also loaded.
+        """
+        return self.select_related(
+            "timeseries_group__gentity",
+            "timeseries_group__unit_of_measurement",
+            "timeseries_group__variable",
+            "group_with",
+        ).prefetch_related(
+            "timeseries_group__timeseries_set", "rateofchangethreshold_set"
+        )
+
 
 class SynopticTimeseriesGroup(models.Model):
     synoptic_group_station = models.ForeignKey(
@@ -359,6 +860,13 @@ class SynopticTimeseriesGroup(models.Model):
             "always expand just enough to accomodate the value."
         ),
     )
+    # The date of the last early warning evaluation that was processed (see
+    # SynopticGroup.update_early_warning_states()); evaluations at this or an earlier
+    # date cannot change anything, unless the limits or thresholds have been changed
+    # in the meantime, which is why save() resets it.
+    last_early_warning_evaluation = models.DateTimeField(
+        blank=True, null=True, editable=False
+    )
 
     objects = SynopticTimeseriesGroupManager()
 
@@ -372,12 +880,32 @@ class SynopticTimeseriesGroup(models.Model):
     def __str__(self):
         return str(self.synoptic_group_station) + " - " + self.full_name
 
+    def save(self, *args, **kwargs):
+        self.last_early_warning_evaluation = None
+        super().save(*args, **kwargs)
+
     def get_title(self):
         return self.title or self.timeseries_group.get_name()
 
     def get_subtitle(self):
         return self.subtitle or self.timeseries_group.get_name()
 
+    @property
+    def default_timeseries(self):
+        """The default time series of the time series group.
+
+        This is the checked time series if it exists, otherwise the initial, like
+        TimeseriesGroup.default_timeseries; however, it is determined from
+        timeseries_group.timeseries_set.all(), so it does not cause any query if that
+        has been prefetched.
+        """
+        if not hasattr(self, "_default_timeseries"):
+            timeseries = {x.type: x for x in self.timeseries_group.timeseries_set.all()}
+            self._default_timeseries = timeseries.get(
+                Timeseries.CHECKED
+            ) or timeseries.get(Timeseries.INITIAL)
+        return self._default_timeseries
+
     @property
     def full_name(self):
         result = self.get_title()
@@ -402,13 +930,45 @@ class SynopticTimeseriesGroup(models.Model):
 
     @property
     def roc_thresholds(self):
-        thresholds = RateOfChangeThreshold.objects.filter(
-            synoptic_timeseries_group=self
-        ).order_by("delta_t")
-        result = []
-        for threshold in thresholds:
-            result.append(Threshold(threshold.delta_t, threshold.allowed_diff))
-        return result
+        return [
+            Threshold(threshold.delta_t, threshold.allowed_diff)
+            for threshold in self._get_rate_of_change_thresholds()
+        ]
+
+    @property
+    def parsed_roc_thresholds(self):
+        """The rate-of-change thresholds as a list of ParsedThreshold objects.
+
+        These have the delta_t as a timedelta, so that they don't need parsing each
+        time they are used.
+        """
+        if not hasattr(self, "_parsed_roc_thresholds"):
+            self._parsed_roc_thresholds = [
+                ParsedThreshold(
+                    delta_t=threshold.timedelta,
+                    allowed_diff=threshold.allowed_diff,
+                    delta_t_text=threshold.delta_t,
+                )
+                for threshold in self._get_rate_of_change_thresholds()
+            ]
+        return self._parsed_roc_thresholds
+
+    @property
+    def roc_timedelta(self):
+        """The longest delta_t of the rate-of-change thresholds (zero if none)."""
+        return max(
+            (x.delta_t for x in self.parsed_roc_thresholds), default=dt.timedelta(0)
+        )
+
+    def _get_rate_of_change_thresholds(self):
+        # The thresholds are read once (or taken from the prefetched ones, if
+        # available) and cached. We sort in Python rather than using order_by() so
+        # that prefetched thresholds are used.
+        if not hasattr(self, "_rate_of_change_thresholds"):
+            self._rate_of_change_thresholds = sorted(
+                self.rateofchangethreshold_set.all(), key=lambda x: x.delta_t
+            )
+        return self._rate_of_change_thresholds
 
     def get_roc_thresholds_as_text(self):
         result = ""
@@ -417,6 +977,7 @@ class SynopticTimeseriesGroup(models.Model):
         return result
 
     def set_roc_thresholds(self, s):
+        self._forget_rate_of_change_thresholds()
         self.rateofchangethreshold_set.all().delete()
         for line in s.splitlines():
             delta_t, allowed_diff = line.split()
@@ -426,6 +987,13 @@ class SynopticTimeseriesGroup(models.Model):
                 allowed_diff=allowed_diff,
             ).save()
 
+    def _forget_rate_of_change_thresholds(self):
+        for attr in ("_rate_of_change_thresholds", "_parsed_roc_thresholds"):
+            if hasattr(self, attr):
+                delattr(self, attr)
+        if hasattr(self, "_prefetched_objects_cache"):
+            self._prefetched_objects_cache.pop("rateofchangethreshold_set", None)
+
     # End of rate-of-change-check stuff
 
 
@@ -445,6 +1013,15 @@ class RateOfChangeThreshold(models.Model):
         else:
             return True
 
+    @property
+    def timedelta(self):
+        if self.delta_t.endswith("min"):
+            return dt.timedelta(minutes=int(self.delta_t[:-3]))
+        elif self.delta_t[-1] == "H":
+            return dt.timedelta(hours=int(self.delta_t[:-1]))
+        elif self.delta_t[-1] == "D":
+            return dt.timedelta(days=int(self.delta_t[:-1]))
+
     def save(self, *args, **kwargs):
         if not self.is_delta_t_valid(self.delta_t):
             raise DataError(f'"{ self.delta_t }" is not a valid delta_t')
@@ -452,3 +1029,41 @@ class RateOfChangeThreshold(models.Model):
 
 
 # End of rate-of-change stuff
+
+
+class EarlyWarningState(models.Model):
+    """The state of an early warning condition of a synoptic time series group.
+
+    The condition is "low", "high" or "rate_of_change". A warning starts at "onset",
+    the first date at which the condition was found (an email is sent then); it is
+    updated to "last_seen" in each later evaluation that finds it again (no email is
+    sent); and it ends at "cleared", the first date at which the condition was not
+    found (an email is sent again). If the condition is found again after that, the
+    same row is reused for the new warning. The dates are last common dates of the
+    station. The states are updated by SynopticGroup.send_early_warning_emails(),
+    only if the email is sent.
+    """
+
+    CONDITIONS = (
+        ("low", _("Lower than the low limit")),
+        ("high", _("Higher than the high limit")),
+        ("rate_of_change", _("Rate of change")),
+    )
+
+    synoptic_timeseries_group = models.ForeignKey(
+        SynopticTimeseriesGroup, on_delete=models.CASCADE
+    )
+    condition = models.CharField(max_length=20, choices=CONDITIONS)
+    onset = models.DateTimeField()
+    last_seen = models.DateTimeField()
+    cleared = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        unique_together = (("synoptic_timeseries_group", "condition"),)
+
+    def __str__(self):
+        return f"{self.synoptic_timeseries_group} {self.condition}"
+
+    @property
+    def last_updated(self):
+        return max(self.last_seen, self.cleared or self.last_seen)
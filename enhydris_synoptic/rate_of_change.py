@@ -0,0 +1,54 @@
+"""Rate-of-change check of the last record of a time series.
+
+This does the same check as the "rocc" module, but only for a single record: for
+each threshold, the value of the record is compared with the values of the records
+that precede it by at most delta_t, and the check fails if the difference exceeds
+allowed_diff (or, if allowed_diff is negative, i.e. a limit to the rate of fall, if
+the difference is less than allowed_diff). If the check is symmetric, it also fails
+if the difference exceeds allowed_diff in the opposite direction. The thresholds
+are tried in order, and, within a threshold, the records are tried from the most
+recent to the oldest; the first failure is returned.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+# delta_t is a timedelta; delta_t_text is what the user specified (e.g. "10min").
+ParsedThreshold = namedtuple(
+    "ParsedThreshold", ["delta_t", "allowed_diff", "delta_t_text"]
+)
+
+RateOfChangeFailure = namedtuple(
+    "RateOfChangeFailure", ["timestamp", "threshold", "diff"]
+)
+
+
+def check_rate_of_change(data, timestamp, thresholds, symmetric):
+    """Check the record of the dataframe "data" at "timestamp".
+
+    "thresholds" is a list of ParsedThreshold objects. Returns a RateOfChangeFailure
+    object, or None if the check succeeds or if the last record of the dataframe is
+    not at "timestamp".
+    """
+    if not len(data) or data.index[-1] != timestamp:
+        return None
+    index = data.index.values
+    values = data["value"].values
+    current_value = values[-1]
+    for threshold in thresholds:
+        start = np.searchsorted(index, index[-1] - np.timedelta64(threshold.delta_t))
+        diffs = current_value - values[start:-1]
+        if symmetric:
+            fails = np.abs(diffs) > abs(threshold.allowed_diff)
+        elif threshold.allowed_diff < 0:
+            fails = diffs < threshold.allowed_diff
+        else:
+            fails = diffs > threshold.allowed_diff
+        failed_positions = np.flatnonzero(fails)
+        if len(failed_positions):
+            return RateOfChangeFailure(
+                timestamp=timestamp,
+                threshold=threshold,
+                diff=float(diffs[failed_positions[-1]]),
+            )
+    return None
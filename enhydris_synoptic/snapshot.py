@@ -0,0 +1,99 @@
+"""The state of the stations as shown in the synoptic report.
+
+SynopticGroupStation.snapshot is a StationSnapshot; it contains a
+SynopticTimeseriesGroupSnapshot for each synoptic time series group of the station,
+with the data of the last 24 hours, the last value and its status, the early warnings,
+and the few fields of the synoptic time series group and of its time series group that
+the templates and the charts need. Unlike model instances with dataframes attached,
+these objects have __slots__, hold the data in numpy arrays, and contain no references
+to other objects, so they are small and can be pickled (e.g. to be sent to another
+process).
+"""
+import math
+from zoneinfo import ZoneInfo
+
+import pandas as pd
+
+
+class StationSnapshot:
+    __slots__ = ("error", "timeseries_groups")
+
+    def __init__(self, error, timeseries_groups):
+        self.error = error
+        self.timeseries_groups = timeseries_groups
+
+
+class SynopticTimeseriesGroupSnapshot:
+    """The state of a synoptic time series group at the last common date.
+
+    "timestamps" are the timestamps of the data, as naive UTC datetime64 values, and
+    "values" the corresponding values; "value" is the value at the last common date
+    (None if there is no record there); "value_status" is "ok", "low", "high" or
+    "error"; "warnings" is a dict with the early warning texts, by condition.
+    """
+
+    _configuration_fields = (
+        "id",
+        "group_with_id",
+        "title",
+        "subtitle",
+        "full_name",
+        "chart_label",
+        "precision",
+        "unit_symbol",
+        "timezone",
+        "default_chart_min",
+        "default_chart_max",
+    )
+    _readings_fields = ("timestamps", "values", "value", "value_status", "warnings")
+    __slots__ = _configuration_fields + _readings_fields
+
+    def __init__(self, asyntsg, readings):
+        """Create the snapshot from a SynopticTimeseriesGroup and its readings.
+
+        "readings" is a dict with the items of _readings_fields, as created by
+        get_readings().
+        """
+        timeseries_group = asyntsg.timeseries_group
+        self.id = asyntsg.id
+        self.group_with_id = asyntsg.group_with_id
+        self.title = asyntsg.get_title()
+        self.subtitle = asyntsg.subtitle
+        self.full_name = asyntsg.full_name
+        self.chart_label = asyntsg.get_subtitle()
+        self.precision = timeseries_group.precision
+        self.unit_symbol = timeseries_group.unit_of_measurement.symbol
+        self.timezone = timeseries_group.gentity.display_timezone
+        self.default_chart_min = asyntsg.default_chart_min
+        self.default_chart_max = asyntsg.default_chart_max
+        for field in self._readings_fields:
+            setattr(self, field, readings[field])
+
+    @property
+    def value_is_null(self):
+        return self.value is None or math.isnan(self.value)
+
+    @property
+    def data(self):
+        """The data as a dataframe with a "value" column, in the station's timezone."""
+        index = pd.DatetimeIndex(self.timestamps).tz_localize("UTC")
+        return pd.DataFrame(
+            {"value": self.values}, index=index.tz_convert(ZoneInfo(self.timezone))
+        )
+
+
+def get_readings(data, value, value_status, warnings):
+    """Return the readings of a synoptic time series group as a dict.
+
+    "data" is a dataframe with an aware index and a "value" column; the other
+    arguments are as in SynopticTimeseriesGroupSnapshot. The result contains only
+    numpy arrays and plain Python objects; it does not depend on the synoptic group,
+    so it can be cached and shared by all synoptic groups that have the station.
+    """
+    return {
+        "timestamps": data.index.tz_convert(None).values.astype("datetime64[ns]"),
+        "values": data["value"].values.astype(float),
+        "value": None if value is None else float(value),
+        "value_status": value_status,
+        "warnings": warnings,
+    }
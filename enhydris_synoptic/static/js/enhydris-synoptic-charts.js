@@ -0,0 +1,171 @@
+// Draws the charts of a station page from the station's charts.json (used when
+// ENHYDRIS_SYNOPTIC_CHART_BACKEND is "json"). The charts look like the PNG charts:
+// same size, colours, grouping, fill and y limits, and times in UTC.
+
+// Same size and margins as the PNG charts (see _get_chart_figure() in views.py)
+const chartWidth = 320;
+const chartHeight = 200;
+const plotLeft = 32;
+const plotRight = 316.8;
+const plotTop = 6;
+const plotBottom = 170;
+const chartColors = ['red', 'green', 'blue', 'magenta'];
+const hourTickSeconds = 3 * 3600;
+const daySeconds = 86400;
+
+const pad = (n) => String(n).padStart(2, '0');
+
+// Pixel coordinates are rounded to one decimal place to keep the SVG short
+const round = (x) => Math.round(x * 10) / 10;
+
+const formatTime = function (seconds) {
+  const d = new Date(seconds * 1000);
+  return `${pad(d.getUTCHours())}:${pad(d.getUTCMinutes())}`;
+};
+
+const formatDate = function (seconds) {
+  const d = new Date(seconds * 1000);
+  return `${d.getUTCFullYear()}-${pad(d.getUTCMonth() + 1)}-${pad(d.getUTCDate())} →`;
+};
+
+// Same as the PNG charts: the data range plus a 5% margin, extended to include
+// default_chart_min and default_chart_max.
+const getYLimits = function (chart) {
+  const values = [].concat(...chart.lines.map((line) => line.y)).filter((y) => y !== null);
+  let ymin = Math.min(...values);
+  let ymax = Math.max(...values);
+  const margin = 0.05 * ((ymax - ymin) || Math.abs(ymax) || 1);
+  ymin -= margin;
+  ymax += margin;
+  if (chart.default_chart_min) {
+    ymin = Math.min(chart.default_chart_min, ymin);
+  }
+  if (chart.default_chart_max) {
+    ymax = Math.max(chart.default_chart_max, ymax);
+  }
+  return [ymin, ymax];
+};
+
+const getYTicks = function (ymin, ymax) {
+  const roughStep = (ymax - ymin) / 5;
+  const magnitude = 10 ** Math.floor(Math.log10(roughStep));
+  const step = [1, 2, 2.5, 5, 10].map((x) => x * magnitude).find((x) => x >= roughStep);
+  const ticks = [];
+  for (let y = Math.ceil(ymin / step) * step; y <= ymax; y += step) {
+    ticks.push(Number(y.toPrecision(12)));
+  }
+  return ticks;
+};
+
+// The points of a line, split where there are null values
+const getSegments = function (line, scaleX, scaleY) {
+  const segments = [[]];
+  for (let i = 0; i < line.x.length; i += 1) {
+    if (line.y[i] === null) {
+      segments.push([]);
+    } else {
+      segments[segments.length - 1].push([scaleX(line.x[i]), scaleY(line.y[i])]);
+    }
+  }
+  return segments.filter((segment) => segment.length);
+};
+
+const getPointsAttribute = (segment) => segment.map((p) => p.join(',')).join(' ');
+
+const getFillSvg = function (line, scaleX, scaleY) {
+  return getSegments(line, scaleX, scaleY).map((segment) => {
+    const first = segment[0];
+    const last = segment[segment.length - 1];
+    const points = [[first[0], plotBottom], ...segment, [last[0], plotBottom]];
+    return `<polygon points="${getPointsAttribute(points)}" fill="#ffff00"/>`;
+  }).join('');
+};
+
+const getGridSvg = function (xmin, xmax, yticks, scaleX, scaleY) {
+  const result = [];
+  const gridLine = (x1, y1, x2, y2) => (
+    `<line x1="${x1}" y1="${y1}" x2="${x2}" y2="${y2}" stroke="blue" stroke-dasharray="1,2" stroke-width="0.5"/>`
+  );
+  for (let x = Math.ceil(xmin / hourTickSeconds) * hourTickSeconds; x <= xmax;
+    x += hourTickSeconds) {
+    const sx = scaleX(x);
+    result.push(gridLine(sx, plotTop, sx, plotBottom));
+    result.push(`<text x="${sx}" y="${plotBottom + 9}" text-anchor="middle">${formatTime(x)}</text>`);
+    if (x % daySeconds === 0) {
+      result.push(`<text x="${sx}" y="${plotBottom + 18}">${formatDate(x)}</text>`);
+    }
+  }
+  yticks.forEach((y) => {
+    const sy = scaleY(y);
+    result.push(gridLine(plotLeft, sy, plotRight, sy));
+    result.push(`<text x="${plotLeft - 2}" y="${sy + 3}" text-anchor="end">${y}</text>`);
+  });
+  return result.join('');
+};
+
+const getLegendSvg = function (chart) {
+  if (chart.lines.length <= 1) {
+    return '';
+  }
+  const lineHeight = 11;
+  const width = 8 + 5.5 * Math.max(...chart.lines.map((line) => line.label.length)) + 24;
+  const x = plotRight - width - 4;
+  const y = plotTop + 4;
+  const result = [
+    `<rect x="${x}" y="${y}" width="${width}" height="${chart.lines.length * lineHeight + 4}" fill="white" fill-opacity="0.8" stroke="#cccccc"/>`,
+  ];
+  chart.lines.forEach((line, i) => {
+    const ly = y + 2 + (i + 0.5) * lineHeight;
+    const color = chartColors[i % chartColors.length];
+    result.push(`<line x1="${x + 4}" y1="${ly}" x2="${x + 20}" y2="${ly}" stroke="${color}"/>`);
+    result.push(`<text x="${x + 24}" y="${ly + 3}">${escapeHtml(line.label)}</text>`);
+  });
+  return result.join('');
+};
+
+const getChartSvg = function (chart) {
+  const frame = (
+    `<rect x="${plotLeft}" y="${plotTop}" width="${plotRight - plotLeft}" `
+    + `height="${plotBottom - plotTop}" fill="none" stroke="black" stroke-width="0.8"/>`
+  );
+  const parts = [];
+  if (chart.lines.length && chart.lines.every((line) => line.x.length > 1)) {
+    const lastLine = chart.lines[chart.lines.length - 1];
+    const xmin = lastLine.x[0];
+    const xmax = lastLine.x[lastLine.x.length - 1];
+    const [ymin, ymax] = getYLimits(chart);
+    const scaleX = (x) => round(plotLeft + ((x - xmin) / (xmax - xmin)) * (plotRight - plotLeft));
+    const scaleY = (y) => round(plotBottom - ((y - ymin) / (ymax - ymin)) * (plotBottom - plotTop));
+    parts.push(`<clipPath id="plot-area-${chart.id}">${frame}</clipPath>`);
+    parts.push(`<g clip-path="url(#plot-area-${chart.id})">`);
+    parts.push(getFillSvg(chart.lines[0], scaleX, scaleY));
+    parts.push('</g>');
+    parts.push(getGridSvg(xmin, xmax, getYTicks(ymin, ymax), scaleX, scaleY));
+    parts.push(`<g clip-path="url(#plot-area-${chart.id})" fill="none">`);
+    chart.lines.forEach((line, i) => {
+      const color = chartColors[i % chartColors.length];
+      getSegments(line, scaleX, scaleY).forEach((segment) => {
+        parts.push(`<polyline points="${getPointsAttribute(segment)}" stroke="${color}" stroke-width="1.5"/>`);
+      });
+    });
+    parts.push('</g>');
+    parts.push(getLegendSvg(chart));
+  }
+  parts.push(frame);
+  return (
+    `<svg xmlns="http://www.w3.org/2000/svg" width="${chartWidth}" height="${chartHeight}" `
+    + `viewBox="0 0 ${chartWidth} ${chartHeight}" font-size="9" font-family="sans-serif">`
+    + `${parts.join('')}</svg>`
+  );
+};
+
+fetch('charts.json')
+  .then((response) => response.json())
+  .then((data) => {
+    data.charts.forEach((chart) => {
+      const element = document.querySelector(`.chart[data-chart-id="${chart.id}"]`);
+      if (element) {
+        element.innerHTML = getChartSvg(chart);
+      }
+    });
+  });
@@ -0,0 +1,8 @@
+// Helpers used by both enhydris-synoptic.js and enhydris-synoptic-charts.js
+
+const escapeHtml = function (s) {
+  const replacements = {
+    '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#x27;',
+  };
+  return String(s).replace(/[&<>"']/g, (c) => replacements[c]);
+};
@@ -13,9 +13,9 @@ const setupMarkers = function (dataLayers) {
     Object.keys(station.last_values).forEach(function (key) {
       // Rectangle with info
       const html = (
-        `<strong><a href='${station.target_url}'>${station.name}</a></strong><br>`
-                + `<span class='date ${station.freshness}'>${station.last_common_date_pretty_without_timezone}</span><br>`
-                + `<span class='value ${station.last_values_status[key]}'>${station.last_values[key]}</span>`
+        `<strong><a href='${escapeHtml(station.target_url)}'>${escapeHtml(station.name)}</a></strong><br>`
+                + `<span class='date ${station.freshness}'>${escapeHtml(station.last_common_date_pretty_without_timezone)}</span><br>`
+                + `<span class='value ${station.last_values_status[key]}'>${escapeHtml(station.last_values[key])}</span>`
       );
       const icon = L.divIcon({ html, iconSize: [105, 55], iconAnchor: [108, 58] });
       L.marker([station.latitude, station.longitude], { icon }).addTo(
@@ -50,7 +50,12 @@ const getDataLayers = function () {
 };
 
 enhydris.map.setUpMap();
-const dataLayers = getDataLayers();
-enhydris.map.layerControl.remove();  // We'll use a different layer control instead
-setupLayersControl(dataLayers);
-setupMarkers(dataLayers);
+fetch(enhydris.mapStationsUrl)
+  .then((response) => response.json())
+  .then((mapStations) => {
+    enhydris.mapStations = mapStations;
+    const dataLayers = getDataLayers();
+    enhydris.map.layerControl.remove();  // We'll use a different layer control instead
+    setupLayersControl(dataLayers);
+    setupMarkers(dataLayers);
+  });
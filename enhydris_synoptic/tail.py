@@ -0,0 +1,126 @@
+"""Reading of the most recent part of a time series.
+
+The synoptic report needs only the last day or so of each time series. Instead of
+reading it through Timeseries.get_data(), we read only the records we need straight
+from the TimeseriesRecord table, from the start date to the end date. With the
+database index on (timeseries, timestamp), the time and memory this needs depend on
+the number of records read, not on the length of the time series.
+"""
+import threading
+from collections import OrderedDict
+from zoneinfo import ZoneInfo
+
+from django.conf import settings
+
+import pandas as pd
+
+from enhydris.models import TimeseriesRecord
+
+
+def read_tail(timeseries, start_date, end_date, timezone):
+    """Return the records of timeseries from start_date to end_date (inclusive).
+
+    The result is a dataframe like the "data" of the HTimeseries object returned by
+    Timeseries.get_data(), i.e. with columns "value" and "flags" and with the
+    timestamps as index; the timestamps are aware and in the specified timezone.
+    """
+    records = (
+        TimeseriesRecord.objects.filter(
+            timeseries_id=timeseries.id,
+            timestamp__gte=start_date,
+            timestamp__lte=end_date,
+        )
+        .order_by("timestamp")
+        .values_list("timestamp", "value", "flags")
+    )
+    timestamps, values, flags = [], [], []
+    for timestamp, value, flag in records:
+        timestamps.append(timestamp)
+        values.append(value)
+        flags.append(flag)
+    index = pd.to_datetime(timestamps, utc=True).tz_convert(ZoneInfo(timezone))
+    return pd.DataFrame(
+        {
+            "value": pd.Series(values, index=index, dtype=float),
+            "flags": pd.Series(flags, index=index, dtype=object),
+        },
+        index=index,
+    )
+
+
+class TailCache(threading.local):
+    """Cache of time series tails, shared by all synoptic groups rendered in a run.
+
+    A station can be in many synoptic groups, and then its time series are needed by
+    all of them. The tails read by read() are therefore kept, keyed by time series and
+    end date, and are reused if a later read() needs the same or a shorter tail. The
+    least recently used tails are dropped when the total size exceeds
+    ENHYDRIS_SYNOPTIC_TAIL_CACHE_SIZE bytes.
+
+    The cache is only used between start_run() and end_run(); start_run() is given an
+    identifier of the run of create_static_files, and the cache is emptied if it
+    changes, so that data is never reused from an earlier run.
+
+    Each thread has its own cache (and its own run), so that tasks executed
+    concurrently in threads of the same process (e.g. with celery's
+    "--pool=threads") don't interfere with one another.
+    """
+
+    def __init__(self):
+        self.run_id = None
+        self.active = False
+        self.hits = 0
+        self.misses = 0
+        self._clear()
+
+    def _clear(self):
+        self._tails = OrderedDict()
+        self.size = 0
+
+    def start_run(self, run_id):
+        if run_id != self.run_id:
+            self._clear()
+            self.hits = 0
+            self.misses = 0
+        self.run_id = run_id
+        self.active = run_id is not None
+
+    def end_run(self):
+        self.active = False
+
+    @property
+    def max_size(self):
+        return getattr(settings, "ENHYDRIS_SYNOPTIC_TAIL_CACHE_SIZE", 50_000_000)
+
+    def read(self, timeseries, start_date, end_date, timezone):
+        """Same as read_tail(), but use the cache if possible."""
+        if not self.active or not self.max_size:
+            return read_tail(timeseries, start_date, end_date, timezone)
+        key = (timeseries.id, end_date)
+        tail = self._tails.get(key)
+        if tail is not None and tail.start_date <= start_date:
+            self.hits += 1
+            self._tails.move_to_end(key)
+            return tail.data.loc[start_date:]
+        self.misses += 1
+        data = read_tail(timeseries, start_date, end_date, timezone)
+        self._add(key, _CachedTail(start_date, data))
+        return data
+
+    def _add(self, key, tail):
+        if key in self._tails:
+            self.size -= self._tails.pop(key).size
+        self._tails[key] = tail
+        self.size += tail.size
+        while self.size > self.max_size:
+            self.size -= self._tails.popitem(last=False)[1].size
+
+
+class _CachedTail:
+    def __init__(self, start_date, data):
+        self.start_date = start_date
+        self.data = data
+        self.size = int(data.memory_usage(deep=True).sum())
+
+
+tail_cache = TailCache()
@@ -1,11 +1,268 @@
+import logging
+import uuid
+from contextlib import closing
+
+from django.conf import settings
+from django.core.mail import get_connection
+
+from celery import chord
+from celery.backends.base import DisabledBackend
+from celery.signals import worker_shutdown
+
 from enhydris.celery import app
 
-from .models import SynopticGroup
-from .views import render_synoptic_group
+from .instrumentation import METRICS, measure
+from .models import SynopticGroup, SynopticGroupStation
+from .tail import tail_cache
+from .views import (
+    render_map_stations,
+    render_synoptic_group_page,
+    render_synoptic_group_stations,
+    shutdown_chart_workers,
+)
+
+logger = logging.getLogger(__name__)
 
 
 @app.task
 def create_static_files():
-    """Create static html files for all enhydris-synoptic."""
-    for sgroup in SynopticGroup.objects.all():
-        render_synoptic_group(sgroup)
+    """Create static html files for all enhydris-synoptic.
+
+    This task only dispatches the work. For each synoptic group, the group page and
+    chunks of ENHYDRIS_SYNOPTIC_STATIONS_PER_TASK stations are rendered by separate
+    subtasks; once all these subtasks finish, the stations.json of the group is
+    written from the map stations they return, and their early warning evaluations
+    are collected. The subtasks executed by the same process during a run share the
+    time series data they read (see tail.TailCache). When all synoptic groups have
+    finished, the early warning emails of all of them are sent together by
+    send_early_warning_emails(), so rendering never waits for the mail server.
+
+    The result of the last task of each synoptic group is a summary of the
+    measurements of its subtasks (see the "instrumentation" module). If this is
+    called directly rather than through celery, or if celery has no result backend
+    (which is needed in order to collect the results of the subtasks), the subtasks
+    are executed in the current process and the list of these summaries is returned;
+    otherwise the id of the result that will contain this list is returned.
+    """
+    run_id = uuid.uuid4().hex
+    signatures = [
+        _get_synoptic_group_signature(sgroup, run_id)
+        for sgroup in SynopticGroup.objects.prefetch_related("synopticgroupstation_set")
+    ]
+    if create_static_files.request.called_directly or not _has_result_backend():
+        summaries = [x.apply().get() for x in signatures]
+        return send_early_warning_emails.apply((summaries,)).get()
+    return chord(signatures, send_early_warning_emails.s()).apply_async().id
+
+
+def _has_result_backend():
+    return not isinstance(app.backend, DisabledBackend)
+
+
+def _get_synoptic_group_signature(sgroup, run_id):
+    station_ids = [x.id for x in sgroup.synopticgroupstation_set.all()]
+    header = [create_synoptic_group_page.si(sgroup.id, run_id=run_id)] + [
+        create_synoptic_group_stations.si(sgroup.id, chunk, run_id=run_id)
+        for chunk in _get_chunks(station_ids)
+    ]
+    return chord(header, finish_synoptic_group.s(sgroup.id))
+
+
+def _get_chunks(items):
+    chunk_size = getattr(settings, "ENHYDRIS_SYNOPTIC_STATIONS_PER_TASK", 10)
+    chunks = []
+    while items:
+        chunks.append(items[:chunk_size])
+        items = items[chunk_size:]
+    return chunks
+
+
+@app.task
+def create_synoptic_group_page(synoptic_group_id, run_id=None):
+    """Render the page of a synoptic group.
+
+    Returns the same as create_synoptic_group_stations(); the page needs no data of
+    the stations, so no stations are loaded, and there are no map stations or early
+    warning evaluations.
+    """
+    return _render_synoptic_group_part(
+        "create_synoptic_group_page",
+        synoptic_group_id,
+        run_id,
+        render_synoptic_group_page,
+        synoptic_group_station_ids=[],
+    )
+
+
+@app.task
+def create_synoptic_group_stations(
+    synoptic_group_id, synoptic_group_station_ids, run_id=None
+):
+    """Render some station pages of a synoptic group.
+
+    Only these stations are loaded, and only their data is read. Returns the entries
+    of the stations in stations.json ("map_stations"), the early warning evaluations,
+    the measurement of the work, and the hits and misses of the time series tail
+    cache. If rendering fails, the entries are those stored when the stations were
+    last rendered, marked as old, so that the stations don't disappear from the map.
+    """
+    return _render_synoptic_group_part(
+        "create_synoptic_group_stations",
+        synoptic_group_id,
+        run_id,
+        render_synoptic_group_stations,
+        synoptic_group_station_ids,
+    )
+
+
+def _render_synoptic_group_part(
+    name, synoptic_group_id, run_id, render, synoptic_group_station_ids
+):
+    # An error is logged and included in the result instead of failing the task;
+    # otherwise the chords would fail, and no early warning emails would be sent for
+    # any synoptic group.
+    tail_cache.start_run(run_id)
+    hits, misses = tail_cache.hits, tail_cache.misses
+    sgroup = None
+    errors = []
+    try:
+        with measure(name, synoptic_group_id=synoptic_group_id) as measurement:
+            with measure("loading"):
+                sgroup = SynopticGroup.objects.get(id=synoptic_group_id)
+                sgroup.load_synoptic_group_stations(synoptic_group_station_ids)
+            map_stations = render(sgroup) or []
+    except Exception as e:
+        errors.append(_log_error(e, name, synoptic_group_id))
+        map_stations = _get_stale_map_stations(synoptic_group_station_ids)
+    finally:
+        tail_cache.end_run()
+    return {
+        "map_stations": map_stations,
+        "early_warning_evaluations": getattr(sgroup, "early_warning_evaluations", {}),
+        "errors": errors,
+        "measurement": measurement.result,
+        "tail_cache_hits": tail_cache.hits - hits,
+        "tail_cache_misses": tail_cache.misses - misses,
+    }
+
+
+def _get_stale_map_stations(synoptic_group_station_ids):
+    map_stations = SynopticGroupStation.objects.get_rendered_map_stations(
+        synoptic_group_station_ids
+    )
+    for map_station in map_stations:
+        map_station["freshness"] = "old"
+    return map_stations
+
+
+def _log_error(exception, name, synoptic_group_id):
+    logger.exception("%s failed for synoptic group %s", name, synoptic_group_id)
+    return f"{name}: {exception!r}"
+
+
+@app.task
+def finish_synoptic_group(subtask_results, synoptic_group_id):
+    """Write stations.json, collect the early warning evaluations, and summarize.
+
+    The stations.json of the synoptic group is written from the map stations of the
+    subtasks. The early warning evaluations of the subtasks are included in the
+    summary, under "early_warning_evaluations", for send_early_warning_emails(). The
+    errors of the subtasks, and of this task, are included under "errors"; they are
+    also logged.
+    """
+    sgroup = None
+    errors = [y for x in subtask_results for y in x["errors"]]
+    with measure(
+        "finish_synoptic_group", synoptic_group_id=synoptic_group_id
+    ) as measurement:
+        try:
+            sgroup = SynopticGroup.objects.get(id=synoptic_group_id)
+            render_map_stations(
+                sgroup, [y for x in subtask_results for y in x["map_stations"]]
+            )
+        except Exception as e:
+            errors.append(_log_error(e, "finish_synoptic_group", synoptic_group_id))
+        early_warning_evaluations = {}
+        for subtask_result in subtask_results:
+            early_warning_evaluations.update(
+                subtask_result["early_warning_evaluations"]
+            )
+    measurements = [x["measurement"] for x in subtask_results] + [measurement.result]
+    return {
+        "synoptic_group": sgroup and sgroup.slug,
+        "synoptic_group_id": synoptic_group_id,
+        **{metric: sum(x[metric] for x in measurements) for metric in METRICS},
+        "tail_cache_hits": sum(x["tail_cache_hits"] for x in subtask_results),
+        "tail_cache_misses": sum(x["tail_cache_misses"] for x in subtask_results),
+        "subtasks": measurements,
+        "early_warning_evaluations": early_warning_evaluations,
+        "errors": errors,
+    }
+
+
+@app.task
+def send_early_warning_emails(summaries):
+    """Update the early warning states and send the emails of all synoptic groups.
+
+    "summaries" is the list of the results of finish_synoptic_group(); it is returned
+    with any errors in sending added to the "errors" of each summary. Each synoptic
+    group's states are updated and its email is sent by
+    SynopticGroup.send_early_warning_emails(), separately from the other groups, so
+    that an error in one group does not affect the others. The emails are sent over
+    a single connection to the mail server, which is opened only if there is an email
+    to send.
+    """
+    with measure("send_early_warning_emails"):
+        with closing(get_connection()) as connection:
+            for summary in summaries:
+                synoptic_group_id = summary["synoptic_group_id"]
+                try:
+                    sgroup = SynopticGroup.objects.prefetch_related(
+                        "earlywarningemail_set"
+                    ).get(id=synoptic_group_id)
+                    sgroup.early_warning_evaluations = summary[
+                        "early_warning_evaluations"
+                    ]
+                    sgroup.send_early_warning_emails(connection)
+                except Exception as e:
+                    summary["errors"].append(
+                        _log_error(e, "send_early_warning_emails", synoptic_group_id)
+                    )
+    return summaries
+
+
+@app.task
+def check_early_warnings():
+    """Check the early warnings of all synoptic groups and email their changes.
+
+    This does the same early warning work as create_static_files, but it renders
+    nothing (no templates and no charts) and it reads only the records needed for the
+    checks, so it is much faster and it can be scheduled more often. The two tasks
+    share the early warning states (see EarlyWarningState), so a warning is emailed
+    only once, by whichever task finds it first. Each synoptic group's email is sent
+    as soon as the group is checked; an error in a group is logged, and the other
+    groups are checked anyway.
+
+    Returns the measurement of the work (see the "instrumentation" module).
+    """
+    tail_cache.start_run(uuid.uuid4().hex)
+    try:
+        with measure("check_early_warnings") as measurement:
+            with closing(get_connection()) as connection:
+                for sgroup in SynopticGroup.objects.for_rendering():
+                    try:
+                        with measure("synoptic_group", synoptic_group=sgroup.slug):
+                            sgroup.check_early_warnings()
+                            sgroup.send_early_warning_emails(connection)
+                    except Exception as e:
+                        _log_error(e, "check_early_warnings", sgroup.id)
+    finally:
+        tail_cache.end_run()
+    return measurement.result
+
+
+@worker_shutdown.connect
+def _shutdown_chart_workers(**kwargs):
+    # The chart worker processes are shared by all tasks executed by the celery
+    # worker (see views.ChartRenderer), so they are stopped only when it exits.
+    shutdown_chart_workers()
@@ -0,0 +1,196 @@
+"""Benchmark of a full synoptic rendering cycle.
+
+This is skipped unless the ENHYDRIS_SYNOPTIC_BENCHMARK environment variable is set to
+the name of the file where the results will be written, e.g.:
+
+    ENHYDRIS_SYNOPTIC_BENCHMARK=/tmp/bench.json \\
+        ./manage.py test enhydris_synoptic.tests.test_benchmark
+
+For each size specified in ENHYDRIS_SYNOPTIC_BENCHMARK_SIZES (a comma-separated list
+of STATIONSxVARIABLESxRECORDS, default "5x4x144,20x4x144,20x8x144,20x4x1440"), it
+creates a synthetic synoptic group on the test database, renders it
+ENHYDRIS_SYNOPTIC_BENCHMARK_REPETITIONS times (default 3), and writes a JSON list with
+one object per size. Each object contains the parameters and the median wall time spent
+in each stage, as measured by the rendering code itself (see the "instrumentation"
+module). Stages with the same name are added together, wherever they are; the time of
+a stage includes the time of the stages nested in it (e.g. "charts" includes "chart").
+"""
+
+import datetime as dt
+import json
+import os
+import shutil
+import statistics
+import tempfile
+from io import StringIO
+from unittest import skipUnless
+
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.contrib.sites.models import Site
+from django.test import TestCase, override_settings
+
+from model_mommy import mommy
+
+from enhydris.models import Station, Timeseries, TimeseriesGroup, Variable
+from enhydris.tests import ClearCacheMixin
+from enhydris_synoptic import views
+from enhydris_synoptic.instrumentation import measure
+from enhydris_synoptic.models import (
+    SynopticGroup,
+    SynopticGroupStation,
+    SynopticTimeseriesGroup,
+)
+
+BENCHMARK_OUTPUT = os.environ.get("ENHYDRIS_SYNOPTIC_BENCHMARK")
+
+
+class BenchmarkData:
+    """Synthetic synoptic group of configurable size.
+
+    It creates a synoptic group with the specified number of stations, each having the
+    specified number of variables, each having a time series with the specified number
+    of ten-minute records ending at END_DATE.
+    """
+
+    END_DATE = dt.datetime(2015, 10, 23, 15, 20)
+
+    def __init__(self, stations, variables, records):
+        self.nstations = stations
+        self.nvariables = variables
+        self.nrecords = records
+        self._create_site()
+        self._create_synoptic_group()
+        self._create_variables()
+        for i in range(self.nstations):
+            self._create_station(i)
+
+    def _create_site(self):
+        site_id = settings.SITE_ID
+        if not Site.objects.filter(id=site_id).exists():
+            mommy.make(Site, id=site_id, domain="example.com", name="example.com")
+
+    def _create_synoptic_group(self):
+        self.sgroup = mommy.make(
+            SynopticGroup,
+            slug="benchmark",
+            fresh_time_limit=dt.timedelta(minutes=60),
+            timezone="Etc/GMT-2",
+        )
+
+    def _create_variables(self):
+        self.variables = [
+            mommy.make(Variable, descr=f"Variable {i}") for i in range(self.nvariables)
+        ]
+
+    def _create_station(self, i):
+        station = mommy.make(
+            Station,
+            name=f"Station {i}",
+            geom=Point(x=21 + i / 100, y=39 + i / 100, srid=4326),
+            display_timezone="Etc/GMT-2",
+        )
+        sgs = mommy.make(
+            SynopticGroupStation, synoptic_group=self.sgroup, station=station, order=i
+        )
+        for j, variable in enumerate(self.variables):
+            self._create_synoptic_timeseries_group(sgs, variable, j)
+
+    def _create_synoptic_timeseries_group(self, sgs, variable, j):
+        timeseries_group = mommy.make(
+            TimeseriesGroup,
+            gentity=sgs.station,
+            variable=variable,
+            name=variable.descr,
+            precision=1,
+            unit_of_measurement__symbol="mm",
+        )
+        mommy.make(
+            Timeseries, timeseries_group=timeseries_group, type=Timeseries.INITIAL
+        )
+        timeseries_group.default_timeseries.set_data(
+            StringIO(self._get_timeseries_csv(j)), default_timezone="Etc/GMT-2"
+        )
+        asyntsg = mommy.make(
+            SynopticTimeseriesGroup,
+            synoptic_group_station=sgs,
+            timeseries_group=timeseries_group,
+            order=j + 1,
+            low_limit=5,
+            high_limit=25,
+        )
+        asyntsg.set_roc_thresholds("10min 5\n1H 10")
+
+    def _get_timeseries_csv(self, j):
+        result = ""
+        for k in range(self.nrecords):
+            date = self.END_DATE - dt.timedelta(minutes=10 * (self.nrecords - k - 1))
+            value = 15 + 10 * ((k + j) % 37) / 37
+            result += f"{date.isoformat(sep=' ', timespec='minutes')},{value},\n"
+        return result
+
+
+def _get_sizes():
+    sizes = os.environ.get(
+        "ENHYDRIS_SYNOPTIC_BENCHMARK_SIZES", "5x4x144,20x4x144,20x8x144,20x4x1440"
+    )
+    return [tuple(int(x) for x in size.split("x")) for size in sizes.split(",")]
+
+
+@skipUnless(BENCHMARK_OUTPUT, "ENHYDRIS_SYNOPTIC_BENCHMARK is not set")
+class BenchmarkTestCase(ClearCacheMixin, TestCase):
+    def test_benchmark(self):
+        results = []
+        for stations, variables, records in _get_sizes():
+            with self.subTest(stations=stations, variables=variables, records=records):
+                sid = self._create_data(stations, variables, records)
+                results.append(self._benchmark(stations, variables, records, sid))
+        with open(BENCHMARK_OUTPUT, "w") as f:
+            json.dump(results, f, indent=2)
+
+    def _create_data(self, stations, variables, records):
+        SynopticGroup.objects.all().delete()
+        return BenchmarkData(stations, variables, records).sgroup.id
+
+    def _benchmark(self, stations, variables, records, synoptic_group_id):
+        repetitions = int(
+            os.environ.get("ENHYDRIS_SYNOPTIC_BENCHMARK_REPETITIONS", "3")
+        )
+        runs = [self._run_once(synoptic_group_id) for i in range(repetitions)]
+        return {
+            "stations": stations,
+            "variables": variables,
+            "records": records,
+            "repetitions": repetitions,
+            "stages": {
+                stage: statistics.median(run.get(stage, 0) for run in runs)
+                for stage in runs[0]
+            },
+        }
+
+    def _run_once(self, synoptic_group_id):
+        synoptic_root = tempfile.mkdtemp()
+        SynopticGroupStation.objects.update(rendering_fingerprint="")
+        try:
+            with override_settings(ENHYDRIS_SYNOPTIC_ROOT=synoptic_root):
+                return self._time_stages(synoptic_group_id)
+        finally:
+            shutil.rmtree(synoptic_root)
+
+    def _time_stages(self, synoptic_group_id):
+        with measure("benchmark") as measurement:
+            with measure("loading"):
+                sgroup = SynopticGroup.objects.for_rendering().get(id=synoptic_group_id)
+                sgroup.last_common_dates
+            views.render_synoptic_group(sgroup)
+        times = {"total": measurement.result["wall_time"]}
+        _add_stage_times(measurement.result, times)
+        return times
+
+
+def _add_stage_times(result, times):
+    for name, stage in result["stages"].items():
+        times[name] = times.get(name, 0) + stage["wall_time"]
+        _add_stage_times(stage, times)
+    for child in result.get("children", []):
+        _add_stage_times(child, times)
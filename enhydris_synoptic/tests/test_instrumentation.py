@@ -0,0 +1,81 @@
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from enhydris_synoptic.instrumentation import add_bytes_written, add_result, measure
+
+
+class MeasureTestCase(TestCase):
+    def setUp(self):
+        with self.assertLogs("enhydris_synoptic.instrumentation") as self.logs:
+            with measure("group", synoptic_group="mygroup") as self.measurement:
+                add_bytes_written(10)
+                for i in range(2):
+                    with measure("station", station=i):
+                        with measure("page"):
+                            add_bytes_written(100)
+                            User.objects.count()
+                with measure("emails"):
+                    User.objects.count()
+                    User.objects.count()
+
+    def test_queries(self):
+        self.assertEqual(self.measurement.result["queries"], 4)
+
+    def test_bytes_written(self):
+        self.assertEqual(self.measurement.result["bytes_written"], 210)
+
+    def test_times(self):
+        result = self.measurement.result
+        self.assertGreaterEqual(result["wall_time"], 0)
+        self.assertGreaterEqual(result["cpu_time"], 0)
+
+    def test_labelled_blocks_are_children(self):
+        children = self.measurement.result["children"]
+        self.assertEqual(
+            [x["labels"] for x in children], [{"station": 0}, {"station": 1}]
+        )
+
+    def test_stages_of_children(self):
+        page = self.measurement.result["children"][1]["stages"]["page"]
+        self.assertEqual(page["count"], 1)
+        self.assertEqual(page["queries"], 1)
+        self.assertEqual(page["bytes_written"], 100)
+
+    def test_stages(self):
+        emails = self.measurement.result["stages"]["emails"]
+        self.assertEqual(emails["count"], 1)
+        self.assertEqual(emails["queries"], 2)
+
+    def test_log_records(self):
+        self.assertEqual(
+            [x.measurement["name"] for x in self.logs.records],
+            ["station", "station", "group"],
+        )
+
+
+class AddResultTestCase(TestCase):
+    def setUp(self):
+        with measure("stations") as self.measurement:
+            with measure("charts"):
+                for i in range(3):
+                    add_result(
+                        {
+                            "name": "chart",
+                            "labels": {},
+                            "wall_time": 0.5,
+                            "cpu_time": 0.25,
+                            "queries": 0,
+                            "bytes_written": 1000,
+                            "stages": {},
+                            "children": [],
+                        }
+                    )
+
+    def test_bytes_written(self):
+        self.assertEqual(self.measurement.result["bytes_written"], 3000)
+
+    def test_stage(self):
+        chart = self.measurement.result["stages"]["charts"]["stages"]["chart"]
+        self.assertEqual(chart["count"], 3)
+        self.assertEqual(chart["wall_time"], 1.5)
+        self.assertEqual(chart["cpu_time"], 0.75)
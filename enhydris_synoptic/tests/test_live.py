@@ -0,0 +1,99 @@
+import json
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from enhydris.tests import ClearCacheMixin
+from enhydris_synoptic import tail
+
+from .data import TestData
+
+
+@override_settings(ROOT_URLCONF="enhydris_synoptic.urls")
+class LiveTestCase(ClearCacheMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.data = TestData()
+
+    def test_synoptic_group_page(self):
+        response = self.client.get("/mygroup/")
+        self.assertContains(response, "All times are in Etc/GMT-1")
+
+    def test_synoptic_group_page_not_found(self):
+        response = self.client.get("/nonexistent/")
+        self.assertEqual(response.status_code, 404)
+
+    def test_map_stations(self):
+        response = self.client.get("/mygroup/stations.json")
+        self.assertEqual(response["Content-Type"], "application/json")
+        names = [x["name"] for x in json.loads(response.content)]
+        self.assertEqual(names, ["Komboti", "Άγιος Αθανάσ…", "Arta"])
+
+    def test_station_page(self):
+        response = self.client.get(f"/mygroup/station/{self.data.station_komboti.id}/")
+        self.assertContains(response, "Komboti")
+
+    def test_station_page_not_found(self):
+        response = self.client.get("/mygroup/station/999999/")
+        self.assertEqual(response.status_code, 404)
+
+    def test_chart(self):
+        response = self.client.get(f"/chart/{self.data.stsg1_1.id}.png")
+        self.assertEqual(response["Content-Type"], "image/png")
+        self.assertEqual(response.content[:8], b"\x89PNG\r\n\x1a\n")
+
+    @override_settings(ENHYDRIS_SYNOPTIC_CHART_BACKEND="json")
+    def test_station_charts(self):
+        response = self.client.get(
+            f"/mygroup/station/{self.data.station_komboti.id}/charts.json"
+        )
+        charts = json.loads(response.content)["charts"]
+        self.assertEqual(charts[0]["id"], self.data.stsg1_1.id)
+
+    def test_last_modified_of_synoptic_group(self):
+        response = self.client.get("/mygroup/")
+        self.assertEqual(response["Last-Modified"], "Fri, 23 Oct 2015 13:20:00 GMT")
+
+    def test_last_modified_of_station(self):
+        response = self.client.get(f"/mygroup/station/{self.data.station_komboti.id}/")
+        self.assertEqual(response["Last-Modified"], "Thu, 22 Oct 2015 13:20:00 GMT")
+
+    def test_not_modified(self):
+        response = self.client.get("/mygroup/stations.json")
+        response = self.client.get(
+            "/mygroup/stations.json", HTTP_IF_NONE_MATCH=response["ETag"]
+        )
+        self.assertEqual(response.status_code, 304)
+
+    def test_different_responses_have_different_etags(self):
+        etag1 = self.client.get("/mygroup/")["ETag"]
+        etag2 = self.client.get("/mygroup/stations.json")["ETag"]
+        self.assertNotEqual(etag1, etag2)
+
+    def test_modified_after_configuration_change(self):
+        etag = self.client.get("/mygroup/stations.json")["ETag"]
+        self.data.stsg1_2.low_limit = 17.1
+        self.data.stsg1_2.save()
+        cache.clear()  # As if ENHYDRIS_SYNOPTIC_LIVE_CACHE_TIMEOUT had elapsed
+        response = self.client.get("/mygroup/stations.json", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_not_modified_without_queries(self):
+        response = self.client.get("/mygroup/stations.json")
+        with self.assertNumQueries(0):
+            response = self.client.get(
+                "/mygroup/stations.json", HTTP_IF_NONE_MATCH=response["ETag"]
+            )
+        self.assertEqual(response.status_code, 304)
+
+    def test_station_page_reads_only_the_station(self):
+        with mock.patch(
+            "enhydris_synoptic.tail.read_tail", side_effect=tail.read_tail
+        ) as mock_read_tail:
+            self.client.get(f"/mygroup/station/{self.data.station_komboti.id}/")
+        station_ids = {
+            args[0].timeseries_group.gentity_id
+            for args, _ in mock_read_tail.call_args_list
+        }
+        self.assertEqual(station_ids, {self.data.station_komboti.id})
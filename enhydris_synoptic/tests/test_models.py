@@ -1,21 +1,30 @@
 import datetime as dt
+import pickle
 import textwrap
 from io import StringIO
+from unittest import mock
 from zoneinfo import ZoneInfo
 
-from django.db import IntegrityError
-from django.test import TestCase
+from django.core import mail
+from django.core.cache import caches
+from django.db import IntegrityError, connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 
 from freezegun import freeze_time
 from model_mommy import mommy
 
 from enhydris.models import Station, Timeseries, TimeseriesGroup
 from enhydris.tests import ClearCacheMixin
+from enhydris_synoptic import tail
 from enhydris_synoptic.models import (
+    EarlyWarningEmail,
+    EarlyWarningState,
     SynopticGroup,
     SynopticGroupStation,
     SynopticTimeseriesGroup,
 )
+from enhydris_synoptic.rate_of_change import ParsedThreshold, RateOfChangeFailure
 
 from .data import TestData
 
@@ -49,6 +58,97 @@ class SynopticGroupTestCase(TestCase):
         self.assertEqual(str(sg), "hello world")
 
 
+class SynopticGroupStationsTestCase(ClearCacheMixin, TestCase):
+    def setUp(self):
+        self.data = TestData()
+        self.synoptic_group = SynopticGroup.objects.get(id=self.data.sg1.id)
+
+    def test_stations(self):
+        self.assertEqual(
+            [x.id for x in self.synoptic_group.synoptic_group_stations],
+            [self.data.sgs_komboti.id, self.data.sgs_agios.id, self.data.sgs_arta.id],
+        )
+
+    def test_stations_are_the_same_objects_each_time(self):
+        stations1 = self.synoptic_group.synoptic_group_stations
+        stations2 = self.synoptic_group.synoptic_group_stations
+        for station1, station2 in zip(stations1, stations2):
+            self.assertIs(station1, station2)
+
+    def test_stations_refer_to_the_group_object(self):
+        for station in self.synoptic_group.synoptic_group_stations:
+            self.assertIs(station.synoptic_group, self.synoptic_group)
+
+    def test_load_some_stations(self):
+        self.synoptic_group.load_synoptic_group_stations(
+            [self.data.sgs_agios.id, self.data.sgs_komboti.id]
+        )
+        self.assertEqual(
+            [x.id for x in self.synoptic_group.synoptic_group_stations],
+            [self.data.sgs_komboti.id, self.data.sgs_agios.id],
+        )
+        for station in self.synoptic_group.synoptic_group_stations:
+            self.assertIs(station.synoptic_group, self.synoptic_group)
+
+    def test_last_common_dates_of_loaded_stations_only(self):
+        self.synoptic_group.load_synoptic_group_stations([self.data.sgs_komboti.id])
+        self.assertEqual(
+            list(self.synoptic_group.last_common_dates), [self.data.sgs_komboti.id]
+        )
+
+
+class SynopticGroupForRenderingTestCase(ClearCacheMixin, TestCase):
+    def setUp(self):
+        self.data = TestData()
+
+    def _get_number_of_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            for sgroup in SynopticGroup.objects.for_rendering():
+                self._use_synoptic_group(sgroup)
+        return len(context.captured_queries)
+
+    def _use_synoptic_group(self, sgroup):
+        sgroup.last_common_dates
+        [x.email for x in sgroup.earlywarningemail_set.all()]
+        for sgs in sgroup.synoptic_group_stations:
+            sgs.target_url
+            sgs.primary_synoptic_timeseries_groups
+            for asyntsg in sgs.synoptictimeseriesgroup_set.all():
+                asyntsg.full_name
+                asyntsg.timeseries_group.unit_of_measurement.symbol
+                asyntsg.group_with and asyntsg.group_with.get_title()
+                asyntsg.roc_thresholds
+                asyntsg.default_timeseries
+
+    def _add_station(self):
+        station = mommy.make(Station, name="Preveza", display_timezone="Etc/GMT-2")
+        sgs = mommy.make(
+            SynopticGroupStation,
+            synoptic_group=self.data.sg1,
+            station=station,
+            order=4,
+        )
+        for i in range(1, 3):
+            timeseries_group = mommy.make(
+                TimeseriesGroup, gentity=station, name=f"Variable {i}"
+            )
+            mommy.make(
+                Timeseries, timeseries_group=timeseries_group, type=Timeseries.INITIAL
+            )
+            asyntsg = mommy.make(
+                SynopticTimeseriesGroup,
+                synoptic_group_station=sgs,
+                timeseries_group=timeseries_group,
+                order=i,
+            )
+            asyntsg.set_roc_thresholds("10min 5\n1H 10")
+
+    def test_number_of_queries_does_not_depend_on_number_of_stations(self):
+        number_of_queries = self._get_number_of_queries()
+        self._add_station()
+        self.assertEqual(self._get_number_of_queries(), number_of_queries)
+
+
 class SynopticGroupStationTestCase(TestCase):
     def test_create(self):
         sg = mommy.make(SynopticGroup)
@@ -75,6 +175,31 @@ class SynopticGroupStationTestCase(TestCase):
         self.assertEqual(str(sgs), "hello")
 
 
+class RateOfChangeMessageTestCase(TestCase):
+    def _get_message(self, diff, allowed_diff):
+        failure = RateOfChangeFailure(
+            timestamp=dt.datetime(2015, 10, 22, 15, 20, tzinfo=ZoneInfo("Etc/GMT-2")),
+            threshold=ParsedThreshold(dt.timedelta(minutes=10), allowed_diff, "10min"),
+            diff=diff,
+        )
+        return SynopticGroupStation()._rate_of_change_message(failure)
+
+    def test_rise(self):
+        self.assertEqual(
+            self._get_message(7.0, 5.0), "2015-10-22T15:20  +7.0 in 10min (> 5.0)"
+        )
+
+    def test_fall(self):
+        self.assertEqual(
+            self._get_message(-7.0, 5.0), "2015-10-22T15:20  -7.0 in 10min (< -5.0)"
+        )
+
+    def test_fall_with_negative_threshold(self):
+        self.assertEqual(
+            self._get_message(-7.0, -5.0), "2015-10-22T15:20  -7.0 in 10min (< -5.0)"
+        )
+
+
 class SynopticGroupStationCheckIntegrityTestCase(TestCase):
     def setUp(self):
         self.station_komboti = mommy.make(Station, name="Komboti")
@@ -151,6 +276,33 @@ class LastCommonDateTestCase(ClearCacheMixin, TestCase):
             dt.datetime(2015, 10, 23, 15, 20, tzinfo=ZoneInfo("Etc/GMT-2")),
         )
 
+    def test_last_common_date_of_station_without_timeseries(self):
+        self.assertIsNone(self.data.sgs_arta.last_common_date)
+
+    def test_last_common_dates_of_group(self):
+        self.assertEqual(
+            self.data.sg1.last_common_dates,
+            {
+                self.data.sgs_komboti.id: dt.datetime(
+                    2015, 10, 22, 15, 20, tzinfo=ZoneInfo("Etc/GMT-2")
+                ),
+                self.data.sgs_agios.id: dt.datetime(
+                    2015, 10, 23, 15, 20, tzinfo=ZoneInfo("Etc/GMT-2")
+                ),
+            },
+        )
+
+    def test_end_dates(self):
+        timeseries = self.data.tsg_agios_temperature.default_timeseries
+        self.assertEqual(
+            self.data.sg1.end_dates[timeseries.id],
+            dt.datetime(2015, 10, 23, 15, 20, tzinfo=ZoneInfo("Etc/GMT-2")),
+        )
+
+    def test_last_common_dates_of_group_uses_constant_number_of_queries(self):
+        with self.assertNumQueries(6):
+            self.data.sg1.last_common_dates
+
     def test_last_common_date_pretty(self):
         self.assertEqual(
             self.data.sgs_agios.last_common_date_pretty, "23 Oct 2015 15:20 (+0200)"
@@ -175,6 +327,217 @@ class SynopticGroupStationSynopticTimeseriesGroupTestCase(ClearCacheMixin, TestC
     def test_data(self):
         self.assertEqual(len(self.data.sgs_agios.synoptic_timeseries_groups[0].data), 2)
 
+    def test_data_is_24_hours_when_roc_window_is_longer(self):
+        self.data.stsg2_1.set_roc_thresholds("2D 100")
+        self.assertEqual(len(self.data.sgs_agios.synoptic_timeseries_groups[0].data), 2)
+
+    def test_roc_data_covers_roc_window_when_longer_than_24_hours(self):
+        self.data.stsg2_1.set_roc_thresholds("2D 100")
+        data, roc_data = self.data.sgs_agios._read_tsg_data(self.data.stsg2_1)
+        self.assertEqual(len(roc_data), 3)
+
+    def test_roc_data_covers_roc_window_when_shorter_than_24_hours(self):
+        self.data.stsg2_1.set_roc_thresholds("10min 100")
+        data, roc_data = self.data.sgs_agios._read_tsg_data(self.data.stsg2_1)
+        self.assertEqual(len(roc_data), 2)
+
+    def test_configuration_fields(self):
+        syntsg = self.data.sgs_agios.synoptic_timeseries_groups[0]
+        self.assertEqual(syntsg.id, self.data.stsg2_1.id)
+        self.assertEqual(syntsg.full_name, self.data.stsg2_1.full_name)
+        self.assertEqual(syntsg.unit_symbol, "mm")
+
+    def test_snapshot_can_be_pickled(self):
+        snapshot = pickle.loads(pickle.dumps(self.data.sgs_agios.snapshot))
+        self.assertAlmostEqual(snapshot.timeseries_groups[0].value, 0.2)
+        self.assertEqual(len(snapshot.timeseries_groups[0].data), 2)
+
+    def test_model_instances_get_no_data_attributes(self):
+        self.data.sgs_agios.synoptic_timeseries_groups
+        asyntsg = self.data.sgs_agios.synoptictimeseriesgroup_set.first()
+        self.assertFalse(hasattr(asyntsg, "value"))
+
+
+@override_settings(
+    CACHES={
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+        "snapshots": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "snapshots",
+        },
+    },
+    ENHYDRIS_SYNOPTIC_SNAPSHOT_CACHE="snapshots",
+)
+class SnapshotCacheTestCase(ClearCacheMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        caches["snapshots"].clear()
+        self.data = TestData()
+        self.data.stsg1_2.low_limit = 17.1
+        self.data.stsg1_2.save()
+        self.first_komboti = self._get_komboti()
+        self.first_komboti.synoptic_timeseries_groups
+
+    def _get_komboti(self):
+        sgroup = SynopticGroup.objects.for_rendering().get(id=self.data.sg1.id)
+        return sgroup.synoptic_group_stations[0]
+
+    def _get_komboti_from_cache(self):
+        komboti = self._get_komboti()
+        with mock.patch(
+            "enhydris_synoptic.tail.read_tail", side_effect=tail.read_tail
+        ) as self.mock_read_tail:
+            komboti.synoptic_timeseries_groups
+        return komboti
+
+    def test_data_is_not_read_again(self):
+        self._get_komboti_from_cache()
+        self.mock_read_tail.assert_not_called()
+
+    def test_values(self):
+        komboti = self._get_komboti_from_cache()
+        self.assertEqual(
+            [x.value for x in komboti.synoptic_timeseries_groups],
+            [x.value for x in self.first_komboti.synoptic_timeseries_groups],
+        )
+
+    def test_value_status(self):
+        komboti = self._get_komboti_from_cache()
+        self.assertEqual(komboti.synoptic_timeseries_groups[1].value_status, "low")
+
+    def test_data(self):
+        komboti = self._get_komboti_from_cache()
+        self.assertEqual(len(komboti.synoptic_timeseries_groups[0].data), 3)
+
+    def test_early_warnings(self):
+        komboti = self._get_komboti_from_cache()
+        evaluations = komboti.synoptic_group.early_warning_evaluations
+        self.assertEqual(
+            evaluations, self.first_komboti.synoptic_group.early_warning_evaluations
+        )
+        self.assertEqual(
+            list(evaluations[str(self.data.stsg1_2.id)]["warnings"]), ["low"]
+        )
+
+    def test_changed_limit_is_not_taken_from_cache(self):
+        self.data.stsg1_2.low_limit = None
+        self.data.stsg1_2.save()
+        komboti = self._get_komboti_from_cache()
+        self.mock_read_tail.assert_called()
+        self.assertEqual(komboti.synoptic_timeseries_groups[1].value_status, "ok")
+
+
+class EarlyWarningStateTestCase(ClearCacheMixin, TestCase):
+    def setUp(self):
+        self.data = TestData()
+        self.sgroup = SynopticGroup.objects.get(id=self.data.sg1.id)
+
+    def _evaluate(self, minute, warnings):
+        """Update the state with an evaluation of stsg1_2 at 15:<minute>.
+
+        Returns the texts of the warnings queued for sending.
+        """
+        self._set_evaluation(minute, warnings)
+        self.sgroup.update_early_warning_states()
+        return [x["warning_text"] for x in self.sgroup.early_warnings.values()]
+
+    def _set_evaluation(self, minute, warnings):
+        self.sgroup.early_warnings = {}
+        self.sgroup.early_warning_evaluations = {
+            str(self.data.stsg1_2.id): {
+                "synoptic_timeseries_group": self.data.stsg1_2.id,
+                "date": self._date(minute).isoformat(),
+                "station": "Komboti",
+                "variable": "Air temperature",
+                "warnings": warnings,
+            }
+        }
+
+    def _date(self, minute):
+        return dt.datetime(2015, 10, 22, 15, minute, tzinfo=ZoneInfo("Etc/GMT-2"))
+
+    def _get_state(self):
+        return EarlyWarningState.objects.get(
+            synoptic_timeseries_group=self.data.stsg1_2, condition="low"
+        )
+
+    def test_onset(self):
+        self.assertEqual(self._evaluate(20, {"low": "too low"}), ["too low"])
+        state = self._get_state()
+        self.assertEqual(state.onset, self._date(20))
+        self.assertEqual(state.last_seen, self._date(20))
+        self.assertIsNone(state.cleared)
+
+    def test_continuing_warning_is_not_queued(self):
+        self._evaluate(20, {"low": "too low"})
+        self.assertEqual(self._evaluate(30, {"low": "still too low"}), [])
+        state = self._get_state()
+        self.assertEqual(state.onset, self._date(20))
+        self.assertEqual(state.last_seen, self._date(30))
+
+    def test_evaluation_without_new_data_is_ignored(self):
+        self._evaluate(20, {"low": "too low"})
+        self.assertEqual(self._evaluate(20, {}), [])
+        self.assertIsNone(self._get_state().cleared)
+
+    def test_date_of_evaluation_is_stored(self):
+        self._evaluate(20, {})
+        self.data.stsg1_2.refresh_from_db()
+        self.assertEqual(
+            self.data.stsg1_2.last_early_warning_evaluation, self._date(20)
+        )
+
+    def test_earlier_evaluation_is_ignored(self):
+        self._evaluate(30, {})
+        self.assertEqual(self._evaluate(20, {"low": "too low"}), [])
+        self.assertFalse(EarlyWarningState.objects.exists())
+
+    def test_cleared(self):
+        self._evaluate(20, {"low": "too low"})
+        self.assertEqual(self._evaluate(30, {}), ["2015-10-22 15:30 back to normal"])
+        self.assertEqual(self._get_state().cleared, self._date(30))
+
+    def test_nothing_is_queued_while_cleared(self):
+        self._evaluate(20, {"low": "too low"})
+        self._evaluate(30, {})
+        self.assertEqual(self._evaluate(40, {}), [])
+
+    def test_new_onset_after_cleared(self):
+        self._evaluate(20, {"low": "too low"})
+        self._evaluate(30, {})
+        self.assertEqual(
+            self._evaluate(40, {"low": "too low again"}), ["too low again"]
+        )
+        state = self._get_state()
+        self.assertEqual(state.onset, self._date(40))
+        self.assertIsNone(state.cleared)
+
+    @override_settings(EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend")
+    def test_email_is_sent(self):
+        EarlyWarningEmail.objects.create(
+            synoptic_group=self.sgroup, email="someone@blackhole.com"
+        )
+        self._set_evaluation(20, {"low": "too low"})
+        self.sgroup.send_early_warning_emails()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(self._get_state().onset, self._date(20))
+
+    @override_settings(EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend")
+    def test_state_is_not_updated_if_the_email_is_not_sent(self):
+        EarlyWarningEmail.objects.create(
+            synoptic_group=self.sgroup, email="someone@blackhole.com"
+        )
+        self._set_evaluation(20, {"low": "too low"})
+        with mock.patch(
+            "django.core.mail.backends.locmem.EmailBackend.send_messages",
+            side_effect=OSError,
+        ):
+            with self.assertRaises(OSError):
+                self.sgroup.send_early_warning_emails()
+        self.assertFalse(EarlyWarningState.objects.exists())
+        self.data.stsg1_2.refresh_from_db()
+        self.assertIsNone(self.data.stsg1_2.last_early_warning_evaluation)
+
 
 class FreshnessTestCase(ClearCacheMixin, TestCase):
     def setUp(self):
@@ -267,3 +630,46 @@ class SynopticTimeseriesGroupTestCase(TestCase):
             timeseries_group__name="mytimeseriesgroup",
         )
         self.assertEqual(str(stg), "mystation - mytimeseriesgroup (mysubtitle)")
+
+
+class SynopticTimeseriesGroupRocThresholdsTestCase(TestCase):
+    def setUp(self):
+        mommy.make(SynopticTimeseriesGroup).set_roc_thresholds("1H 10\n10min 5")
+        self.stg = SynopticTimeseriesGroup.objects.first()
+
+    def test_parsed_roc_thresholds(self):
+        self.assertEqual(
+            self.stg.parsed_roc_thresholds,
+            [
+                (dt.timedelta(minutes=10), 5, "10min"),
+                (dt.timedelta(hours=1), 10, "1H"),
+            ],
+        )
+
+    def test_roc_timedelta(self):
+        self.assertEqual(self.stg.roc_timedelta, dt.timedelta(hours=1))
+
+    def test_roc_timedelta_without_thresholds(self):
+        self.stg.set_roc_thresholds("")
+        self.assertEqual(self.stg.roc_timedelta, dt.timedelta(0))
+
+    def test_thresholds_are_read_once(self):
+        self.stg.parsed_roc_thresholds
+        with self.assertNumQueries(0):
+            self.stg.parsed_roc_thresholds
+            self.stg.roc_thresholds
+            self.stg.roc_timedelta
+            self.stg.get_roc_thresholds_as_text()
+
+    def test_set_roc_thresholds_invalidates_cache(self):
+        self.stg.parsed_roc_thresholds
+        self.stg.set_roc_thresholds("2D 100")
+        self.assertEqual(self.stg.get_roc_thresholds_as_text(), "2D\t100.0\n")
+        self.assertEqual(self.stg.roc_timedelta, dt.timedelta(days=2))
+
+    def test_set_roc_thresholds_invalidates_prefetched_thresholds(self):
+        stg = SynopticTimeseriesGroup.objects.prefetch_related(
+            "rateofchangethreshold_set"
+        ).first()
+        stg.set_roc_thresholds("2D 100")
+        self.assertEqual(stg.roc_timedelta, dt.timedelta(days=2))
@@ -0,0 +1,98 @@
+import datetime as dt
+from unittest import TestCase
+from zoneinfo import ZoneInfo
+
+import numpy as np
+import pandas as pd
+
+from enhydris_synoptic.rate_of_change import ParsedThreshold, check_rate_of_change
+
+
+def _threshold(minutes, allowed_diff):
+    return ParsedThreshold(dt.timedelta(minutes=minutes), allowed_diff, f"{minutes}min")
+
+
+class CheckRateOfChangeTestCase(TestCase):
+    def setUp(self):
+        tz = ZoneInfo("Etc/GMT-2")
+        self.index = pd.DatetimeIndex(
+            [
+                dt.datetime(2015, 10, 22, 15, minute, tzinfo=tz)
+                for minute in range(0, 60, 10)
+            ]
+        )
+        self.data = pd.DataFrame(
+            data={"value": [5.0, 3.0, 3.2, 2.9, 2.8, 3.1], "flags": [""] * 6},
+            index=self.index,
+        )
+        self.timestamp = self.index[-1]
+
+    def _check(self, thresholds, symmetric=False, timestamp=None):
+        return check_rate_of_change(
+            self.data,
+            timestamp or self.timestamp,
+            thresholds=thresholds,
+            symmetric=symmetric,
+        )
+
+    def test_success(self):
+        self.assertIsNone(self._check([_threshold(20, 0.5)]))
+
+    def test_failure(self):
+        failure = self._check([_threshold(10, 0.25)])
+        self.assertEqual(failure.timestamp, self.timestamp)
+        self.assertEqual(failure.threshold, _threshold(10, 0.25))
+        self.assertAlmostEqual(failure.diff, 0.3)
+
+    def test_most_recent_failure_within_window_is_returned(self):
+        failure = self._check([_threshold(30, 0.1)])
+        self.assertAlmostEqual(failure.diff, 0.3)
+
+    def test_records_outside_window_are_ignored(self):
+        self.assertIsNone(self._check([_threshold(40, 1.5)], symmetric=True))
+
+    def test_negative_difference_ignored_if_not_symmetric(self):
+        self.assertIsNone(self._check([_threshold(50, 0.5)]))
+
+    def test_negative_difference_if_symmetric(self):
+        failure = self._check([_threshold(50, 0.5)], symmetric=True)
+        self.assertEqual(failure.threshold, _threshold(50, 0.5))
+        self.assertAlmostEqual(failure.diff, -1.9)
+
+    def test_negative_threshold_with_flat_series(self):
+        self.data["value"] = 0.0
+        self.assertIsNone(self._check([_threshold(10, -5)]))
+
+    def test_negative_threshold_with_falling_series(self):
+        self.data["value"] = [30.0, 25.0, 20.0, 15.0, 10.0, 3.0]
+        failure = self._check([_threshold(10, -5)])
+        self.assertEqual(failure.threshold, _threshold(10, -5))
+        self.assertAlmostEqual(failure.diff, -7.0)
+
+    def test_negative_threshold_with_rising_series(self):
+        self.data["value"] = [3.0, 10.0, 15.0, 20.0, 25.0, 30.0]
+        self.assertIsNone(self._check([_threshold(10, -5)]))
+
+    def test_negative_threshold_if_symmetric(self):
+        self.data["value"] = [3.0, 10.0, 15.0, 20.0, 25.0, 32.0]
+        failure = self._check([_threshold(10, -5)], symmetric=True)
+        self.assertAlmostEqual(failure.diff, 7.0)
+
+    def test_first_failing_threshold_is_returned(self):
+        failure = self._check([_threshold(10, 0.5), _threshold(20, 0.1)])
+        self.assertEqual(failure.threshold.delta_t_text, "20min")
+
+    def test_only_last_record_is_checked(self):
+        self.assertIsNone(self._check([_threshold(10, 1.0)], symmetric=True))
+
+    def test_null_value(self):
+        self.data.loc[self.timestamp, "value"] = np.nan
+        self.assertIsNone(self._check([_threshold(10, 0.1)], symmetric=True))
+
+    def test_none_if_last_record_is_not_at_timestamp(self):
+        timestamp = self.timestamp + dt.timedelta(minutes=10)
+        self.assertIsNone(self._check([_threshold(10, 0.25)], timestamp=timestamp))
+
+    def test_empty(self):
+        self.data = self.data.iloc[:0]
+        self.assertIsNone(self._check([_threshold(10, 0.25)]))
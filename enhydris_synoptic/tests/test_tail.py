@@ -0,0 +1,149 @@
+import datetime as dt
+import threading
+from io import StringIO
+from zoneinfo import ZoneInfo
+
+from django.test import TestCase, override_settings
+
+import numpy as np
+from model_mommy import mommy
+
+from enhydris.models import Timeseries
+from enhydris.tests import ClearCacheMixin
+from enhydris_synoptic.tail import TailCache, read_tail
+
+
+class TimeseriesMixin:
+    def setUp(self):
+        super().setUp()
+        self.timeseries = mommy.make(
+            Timeseries,
+            timeseries_group__gentity__display_timezone="Etc/GMT-2",
+            type=Timeseries.INITIAL,
+        )
+        self.timeseries.set_data(
+            StringIO(
+                "2015-10-21 15:00,1,\n"
+                "2015-10-22 15:00,2,\n"
+                "2015-10-22 15:10,,MISSING\n"
+                "2015-10-22 15:20,4,\n"
+                "2015-10-22 15:30,5,\n"
+            ),
+            default_timezone="Etc/GMT-2",
+        )
+        self.tz = ZoneInfo("Etc/GMT-2")
+        self.start_date = dt.datetime(2015, 10, 22, 15, 0, tzinfo=self.tz)
+        self.end_date = dt.datetime(2015, 10, 22, 15, 20, tzinfo=self.tz)
+
+
+class ReadTailTestCase(TimeseriesMixin, ClearCacheMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.data = read_tail(
+            self.timeseries, self.start_date, self.end_date, "Etc/GMT-2"
+        )
+
+    def test_index(self):
+        self.assertEqual(
+            list(self.data.index),
+            [
+                dt.datetime(2015, 10, 22, 15, minute, tzinfo=self.tz)
+                for minute in (0, 10, 20)
+            ],
+        )
+
+    def test_timezone(self):
+        self.assertEqual(self.data.index[0].utcoffset(), dt.timedelta(hours=2))
+
+    def test_values(self):
+        np.testing.assert_array_equal(self.data["value"].values, [2, np.nan, 4])
+
+    def test_flags(self):
+        self.assertEqual(list(self.data["flags"]), ["", "MISSING", ""])
+
+    def test_same_as_get_data(self):
+        data = self.timeseries.get_data(
+            start_date=self.start_date, end_date=self.end_date
+        ).data
+        self.assertEqual(list(self.data.index), list(data.index))
+        np.testing.assert_array_equal(self.data["value"].values, data["value"].values)
+
+    def test_empty(self):
+        data = read_tail(
+            self.timeseries,
+            self.start_date + dt.timedelta(days=1),
+            self.end_date + dt.timedelta(days=1),
+            "Etc/GMT-2",
+        )
+        self.assertEqual(len(data), 0)
+        self.assertEqual(list(data.columns), ["value", "flags"])
+
+
+class TailCacheTestCase(TimeseriesMixin, ClearCacheMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.tail_cache = TailCache()
+        self.tail_cache.start_run("run1")
+
+    def _read(self, start_date=None):
+        return self.tail_cache.read(
+            self.timeseries, start_date or self.start_date, self.end_date, "Etc/GMT-2"
+        )
+
+    def test_miss(self):
+        self._read()
+        self.assertEqual((self.tail_cache.hits, self.tail_cache.misses), (0, 1))
+
+    def test_hit(self):
+        self._read()
+        with self.assertNumQueries(0):
+            data = self._read()
+        self.assertEqual((self.tail_cache.hits, self.tail_cache.misses), (1, 1))
+        self.assertEqual(len(data), 3)
+
+    def test_shorter_tail_is_hit(self):
+        self._read()
+        data = self._read(start_date=self.start_date + dt.timedelta(minutes=10))
+        self.assertEqual(self.tail_cache.hits, 1)
+        self.assertEqual(len(data), 2)
+
+    def test_longer_tail_is_miss(self):
+        self._read()
+        data = self._read(start_date=self.start_date - dt.timedelta(days=1))
+        self.assertEqual(self.tail_cache.misses, 2)
+        self.assertEqual(len(data), 4)
+
+    def test_inactive_after_end_of_run(self):
+        self.tail_cache.end_run()
+        self._read()
+        self._read()
+        self.assertEqual((self.tail_cache.hits, self.tail_cache.misses), (0, 0))
+
+    def test_same_run_is_continued(self):
+        self._read()
+        self.tail_cache.end_run()
+        self.tail_cache.start_run("run1")
+        self._read()
+        self.assertEqual(self.tail_cache.hits, 1)
+
+    def test_new_run_empties_cache(self):
+        self._read()
+        self.tail_cache.end_run()
+        self.tail_cache.start_run("run2")
+        self._read()
+        self.assertEqual((self.tail_cache.hits, self.tail_cache.misses), (0, 1))
+
+    def test_other_thread_does_not_end_run(self):
+        thread = threading.Thread(target=self.tail_cache.end_run)
+        thread.start()
+        thread.join()
+        self._read()
+        self._read()
+        self.assertEqual((self.tail_cache.hits, self.tail_cache.misses), (1, 1))
+
+    @override_settings(ENHYDRIS_SYNOPTIC_TAIL_CACHE_SIZE=1)
+    def test_size_limit(self):
+        self._read()
+        self._read()
+        self.assertEqual(self.tail_cache.misses, 2)
+        self.assertEqual(self.tail_cache.size, 0)
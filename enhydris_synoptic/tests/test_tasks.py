@@ -1,15 +1,19 @@
 import datetime as dt
+import json
 import locale
 import os
 import shutil
 import tempfile
+import textwrap
 from io import StringIO
-from unittest import skipUnless
+from unittest import mock, skipUnless
 from urllib.parse import urlparse
 
 from django.conf import settings
+from django.contrib.gis.geos import Point
 from django.core import mail
 from django.core.cache import cache
+from django.core.mail import get_connection
 from django.http import HttpResponse
 from django.test import TestCase, override_settings
 
@@ -17,11 +21,18 @@ import numpy as np
 from bs4 import BeautifulSoup
 from django_selenium_clean import PageElement
 from freezegun import freeze_time
+from model_mommy import mommy
 from selenium.webdriver.common.by import By
 
 from enhydris.tests import ClearCacheMixin, SeleniumTestCase
-from enhydris_synoptic import models
-from enhydris_synoptic.tasks import create_static_files
+from enhydris_synoptic import models, tail
+from enhydris_synoptic.tasks import (
+    _get_chunks,
+    check_early_warnings,
+    create_static_files,
+    create_synoptic_group_page,
+    send_early_warning_emails,
+)
 
 from .data import TestData
 
@@ -78,6 +89,34 @@ class MainPageTestCase(TestCase):
             output = f.read()
         self.assertIn("All times are in Etc/GMT-1", output)
 
+    def _get_map_stations(self):
+        root = settings.ENHYDRIS_SYNOPTIC_ROOT
+        filename = os.path.join(root, "mygroup", "stations.json")
+        with open(filename, encoding="utf-8") as f:
+            return json.load(f)
+
+    def test_map_station_names(self):
+        names = [x["name"] for x in self._get_map_stations()]
+        self.assertEqual(names, ["Komboti", "Άγιος Αθανάσ…", "Arta"])
+
+    def test_map_station_last_values(self):
+        komboti = self._get_map_stations()[0]
+        self.assertEqual(komboti["last_values"]["Rain"], "0 mm")
+        self.assertEqual(komboti["last_values_status"]["Rain"], "ok")
+
+    def test_map_station_date(self):
+        komboti = self._get_map_stations()[0]
+        self.assertEqual(
+            komboti["last_common_date_pretty_without_timezone"], "22 Oct 2015 14:20"
+        )
+
+    def test_page_does_not_contain_last_values(self):
+        root = settings.ENHYDRIS_SYNOPTIC_ROOT
+        filename = os.path.join(root, "mygroup", "index.html")
+        with open(filename, encoding="utf-8") as f:
+            output = f.read()
+        self.assertNotIn("Komboti", output)
+
 
 @RandomSynopticRoot()
 class ChartTestCase(ClearCacheMixin, TestCase):
@@ -159,6 +198,54 @@ class ChartTestCase(ClearCacheMixin, TestCase):
         np.testing.assert_allclose(data_array[1], desired_result[1], rtol=1e-6)
 
 
+@override_settings(ENHYDRIS_SYNOPTIC_CHART_WORKERS=2)
+class ParallelChartTestCase(ChartTestCase):
+    pass
+
+
+@RandomSynopticRoot()
+@override_settings(ENHYDRIS_SYNOPTIC_CHART_BACKEND="json")
+class JsonChartTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.data = TestData()
+        create_static_files()
+        cls.station_dir = os.path.join(
+            settings.ENHYDRIS_SYNOPTIC_ROOT,
+            "mygroup",
+            "station",
+            str(cls.data.station_komboti.id),
+        )
+        with open(os.path.join(cls.station_dir, "charts.json")) as f:
+            cls.charts = json.load(f)["charts"]
+
+    def test_charts_of_primary_synoptic_timeseries_groups(self):
+        self.assertEqual(
+            [x["id"] for x in self.charts],
+            [self.data.stsg1_1.id, self.data.stsg1_2.id, self.data.stsg1_3.id],
+        )
+
+    def test_grouped_chart(self):
+        lines = self.charts[2]["lines"]
+        self.assertEqual([x["label"] for x in lines], ["gust", "speed"])
+        self.assertEqual(lines[0]["x"], [1445518800, 1445519400, 1445520000])
+        self.assertEqual(lines[0]["y"], [3.7, 4.5, 4.1])
+        self.assertEqual(lines[1]["y"], [2.9, 3.2, 3])
+
+    def test_no_png_charts(self):
+        filename = os.path.join(
+            settings.ENHYDRIS_SYNOPTIC_ROOT, "chart", f"{self.data.stsg1_1.id}.png"
+        )
+        self.assertFalse(os.path.exists(filename))
+
+    def test_station_page(self):
+        with open(os.path.join(self.station_dir, "index.html")) as f:
+            content = f.read()
+        self.assertIn(f'data-chart-id="{self.data.stsg1_3.id}"', content)
+        self.assertIn("enhydris-synoptic-charts.js", content)
+
+
 @RandomSynopticRoot()
 class StationReportTestCase(ClearCacheMixin, TestCase):
     @classmethod
@@ -195,6 +282,167 @@ class StationReportTestCase(ClearCacheMixin, TestCase):
         self._check(4, "Wind speed", "")
 
 
+@RandomSynopticRoot()
+class DataReadsTestCase(ClearCacheMixin, TestCase):
+    def setUp(self):
+        self.data = TestData()
+        with mock.patch(
+            "enhydris_synoptic.tail.read_tail", side_effect=tail.read_tail
+        ) as self.mock_read_tail:
+            create_static_files()
+
+    def test_same_data_is_not_read_twice(self):
+        reads = [
+            (args[0].id, kwargs.get("start_date"), kwargs.get("end_date"))
+            for args, kwargs in self.mock_read_tail.call_args_list
+        ]
+        self.assertEqual(len(reads), len(set(reads)))
+
+    def test_each_timeseries_is_read_once(self):
+        timeseries_ids = [args[0].id for args, _ in self.mock_read_tail.call_args_list]
+        self.assertEqual(len(timeseries_ids), 7)
+        self.assertEqual(len(set(timeseries_ids)), 7)
+
+    def test_group_page_reads_no_data(self):
+        with mock.patch("enhydris_synoptic.tail.read_tail") as mock_read_tail:
+            create_synoptic_group_page(self.data.sg1.id)
+        mock_read_tail.assert_not_called()
+
+
+@RandomSynopticRoot()
+class MeasurementSummaryTestCase(ClearCacheMixin, TestCase):
+    def setUp(self):
+        self.data = TestData()
+        with self.assertLogs("enhydris_synoptic.instrumentation") as self.logs:
+            (self.summary,) = create_static_files()
+
+    def test_synoptic_group(self):
+        self.assertEqual(self.summary["synoptic_group"], "mygroup")
+
+    def test_subtasks(self):
+        names = [x["name"] for x in self.summary["subtasks"]]
+        self.assertEqual(
+            names,
+            [
+                "create_synoptic_group_page",
+                "create_synoptic_group_stations",
+                "finish_synoptic_group",
+            ],
+        )
+
+    def test_stations(self):
+        stations_subtask = self.summary["subtasks"][1]
+        station_ids = {x["labels"]["station"] for x in stations_subtask["children"]}
+        self.assertEqual(
+            station_ids, {self.data.station_komboti.id, self.data.station_agios.id}
+        )
+
+    def test_bytes_written(self):
+        self.assertGreater(self.summary["bytes_written"], 0)
+        self.assertEqual(
+            self.summary["bytes_written"],
+            sum(x["bytes_written"] for x in self.summary["subtasks"]),
+        )
+
+    def test_queries(self):
+        self.assertGreater(self.summary["subtasks"][0]["queries"], 0)
+
+    def test_chart_stage(self):
+        stations_subtask = self.summary["subtasks"][1]
+        station = stations_subtask["children"][0]
+        self.assertGreater(station["stages"]["charts"]["stages"]["chart"]["count"], 0)
+
+    def test_station_log_records(self):
+        station_records = [
+            x for x in self.logs.records if x.measurement["name"] == "station"
+        ]
+        self.assertEqual(len(station_records), 2)
+
+
+@RandomSynopticRoot()
+class IncrementalRenderingTestCase(ClearCacheMixin, TestCase):
+    def setUp(self):
+        self.data = TestData()
+        create_static_files()
+
+    def _get_rendered_station_ids(self):
+        with mock.patch("enhydris_synoptic.views._render_station_page") as m:
+            create_static_files()
+        return {args[0].id for args, _ in m.call_args_list}
+
+    def test_unchanged_stations_are_not_rendered_again(self):
+        self.assertEqual(self._get_rendered_station_ids(), set())
+
+    def test_data_of_unchanged_stations_is_not_read_again(self):
+        with mock.patch(
+            "enhydris_synoptic.tail.read_tail", side_effect=tail.read_tail
+        ) as mock_read_tail:
+            create_static_files()
+        mock_read_tail.assert_not_called()
+
+    def test_map_stations_of_unchanged_stations(self):
+        filename = os.path.join(
+            settings.ENHYDRIS_SYNOPTIC_ROOT, self.data.sg1.slug, "stations.json"
+        )
+        with open(filename, encoding="utf-8") as f:
+            original_content = f.read()
+        create_static_files()
+        with open(filename, encoding="utf-8") as f:
+            self.assertEqual(f.read(), original_content)
+
+    def test_station_with_new_data_is_rendered_again(self):
+        self.data.tsg_komboti_temperature.default_timeseries.set_data(
+            StringIO(
+                textwrap.dedent(
+                    """\
+                    2015-10-22 15:00,15,
+                    2015-10-22 15:10,16,
+                    2015-10-22 15:20,17,
+                    2015-10-22 15:30,18,
+                    """
+                )
+            ),
+            default_timezone="Etc/GMT-2",
+        )
+        self.assertEqual(self._get_rendered_station_ids(), {self.data.sgs_komboti.id})
+
+    def test_station_with_changed_configuration_is_rendered_again(self):
+        self.data.stsg2_2.title = "Temperature"
+        self.data.stsg2_2.save()
+        self.assertEqual(self._get_rendered_station_ids(), {self.data.sgs_agios.id})
+
+    def test_moved_station_is_rendered_again(self):
+        self.data.station_arta.geom = Point(x=20.98, y=39.16, srid=4326)
+        self.data.station_arta.save()
+        self.assertEqual(self._get_rendered_station_ids(), {self.data.sgs_arta.id})
+
+    @property
+    def _all_station_ids(self):
+        return {self.data.sgs_komboti.id, self.data.sgs_agios.id, self.data.sgs_arta.id}
+
+    def test_all_stations_are_rendered_again_when_rendering_settings_change(self):
+        with override_settings(ENHYDRIS_SYNOPTIC_CHART_DOWNSAMPLING=False):
+            rendered_station_ids = self._get_rendered_station_ids()
+        self.assertEqual(rendered_station_ids, self._all_station_ids)
+
+    def test_all_stations_are_rendered_again_when_rendering_version_changes(self):
+        new_version = models.RENDERING_VERSION + 1
+        with mock.patch("enhydris_synoptic.models.RENDERING_VERSION", new_version):
+            rendered_station_ids = self._get_rendered_station_ids()
+        self.assertEqual(rendered_station_ids, self._all_station_ids)
+
+    def test_station_whose_page_is_missing_is_rendered_again(self):
+        filename = os.path.join(
+            settings.ENHYDRIS_SYNOPTIC_ROOT,
+            self.data.sg1.slug,
+            "station",
+            str(self.data.station_arta.id),
+            "index.html",
+        )
+        os.remove(filename)
+        self.assertEqual(self._get_rendered_station_ids(), {self.data.sgs_arta.id})
+
+
 @RandomSynopticRoot()
 class AsciiSystemLocaleTestCase(ClearCacheMixin, AssertHtmlContainsMixin, TestCase):
     def setUp(self):
@@ -427,6 +675,34 @@ class EmailTestCase(ClearCacheMixin, TestCase, EarlyWarningTestMixin):
         create_static_files()
         self.assertEqual(len(mail.outbox), 1)
 
+    def test_does_not_send_email_again_without_new_data(self):
+        self._set_limits(low_temperature=17.1, high_gust=4)
+        models.EarlyWarningEmail.objects.create(
+            synoptic_group=self.data.sg1, email="someone@blackhole.com"
+        )
+        create_static_files()
+        with mock.patch(
+            "enhydris_synoptic.tail.read_tail", side_effect=tail.read_tail
+        ) as mock_read_tail:
+            create_static_files()
+        self.assertEqual(len(mail.outbox), 1)
+        mock_read_tail.assert_not_called()
+
+    def test_sends_email_despite_error_in_rendering(self):
+        self._set_limits(low_temperature=17.1, high_gust=4)
+        models.EarlyWarningEmail.objects.create(
+            synoptic_group=self.data.sg1, email="someone@blackhole.com"
+        )
+        with mock.patch(
+            "enhydris_synoptic.tasks.render_synoptic_group_page",
+            side_effect=RuntimeError("oops"),
+        ), self.assertLogs("enhydris_synoptic.tasks"):
+            (summary,) = create_static_files()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(
+            summary["errors"], ["create_synoptic_group_page: RuntimeError('oops')"]
+        )
+
     def test_does_not_send_email_if_no_emails_are_registered(self):
         self._set_limits(low_temperature=17.1, high_gust=4)
         create_static_files()
@@ -441,6 +717,58 @@ class EmailTestCase(ClearCacheMixin, TestCase, EarlyWarningTestMixin):
         self.assertEqual(len(mail.outbox), 0)
 
 
+@override_settings(ENHYDRIS_SYNOPTIC_STATIONS_PER_TASK=1)
+class OneStationPerTaskEmailTestCase(EmailTestCase):
+    pass
+
+
+@RandomSynopticRoot()
+@override_settings(ENHYDRIS_SYNOPTIC_STATIONS_PER_TASK=2)
+class StationChunksTestCase(ClearCacheMixin, TestCase):
+    def setUp(self):
+        self.data = TestData()
+        create_static_files()
+
+    def test_chunks(self):
+        self.assertEqual(_get_chunks([1, 2, 3, 4, 5]), [[1, 2], [3, 4], [5]])
+
+    def test_map_stations_of_all_chunks(self):
+        filename = os.path.join(
+            settings.ENHYDRIS_SYNOPTIC_ROOT, self.data.sg1.slug, "stations.json"
+        )
+        with open(filename, encoding="utf-8") as f:
+            names = [x["name"] for x in json.load(f)]
+        self.assertEqual(names, ["Komboti", "Άγιος Αθανάσ…", "Arta"])
+
+    def test_map_stations_of_failed_chunk_are_kept_as_old(self):
+        models.SynopticGroupStation.objects.update(rendering_fingerprint="")
+        with mock.patch(
+            "enhydris_synoptic.views._render_station_page",
+            side_effect=RuntimeError("oops"),
+        ), self.assertLogs("enhydris_synoptic.tasks"):
+            create_static_files()
+        filename = os.path.join(
+            settings.ENHYDRIS_SYNOPTIC_ROOT, self.data.sg1.slug, "stations.json"
+        )
+        with open(filename, encoding="utf-8") as f:
+            map_stations = json.load(f)
+        self.assertEqual(
+            [x["name"] for x in map_stations], ["Komboti", "Άγιος Αθανάσ…", "Arta"]
+        )
+        self.assertEqual({x["freshness"] for x in map_stations}, {"old"})
+
+    def test_all_station_pages_are_rendered(self):
+        for sgs in (self.data.sgs_komboti, self.data.sgs_agios, self.data.sgs_arta):
+            filename = os.path.join(
+                settings.ENHYDRIS_SYNOPTIC_ROOT,
+                self.data.sg1.slug,
+                "station",
+                str(sgs.station.id),
+                "index.html",
+            )
+            self.assertTrue(os.path.exists(filename))
+
+
 @RandomSynopticRoot()
 @override_settings(
     EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend",
@@ -489,6 +817,146 @@ class EmailSubjectTestCase(TestCase):
         self.assertEqual(synoptic_group._get_warning_email_subject(), expected_subject)
 
 
+@RandomSynopticRoot()
+@override_settings(EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend")
+class CheckEarlyWarningsTestCase(ClearCacheMixin, TestCase, EarlyWarningTestMixin):
+    def setUp(self):
+        self.data = TestData()
+        self._set_limits(low_temperature=17.1, high_gust=4)
+        models.EarlyWarningEmail.objects.create(
+            synoptic_group=self.data.sg1, email="someone@blackhole.com"
+        )
+        self.result = check_early_warnings()
+
+    def test_sends_email(self):
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(
+            mail.outbox[0].body,
+            "Komboti Air temperature 2015-10-22 15:20 17.0 (low limit 17.1)\n"
+            "Komboti Wind 2015-10-22 15:20 4.1 (high limit 4.0)\n",
+        )
+
+    def test_renders_nothing(self):
+        self.assertEqual(os.listdir(settings.ENHYDRIS_SYNOPTIC_ROOT), [])
+
+    def test_reads_only_the_rate_of_change_window(self):
+        # There are no rate-of-change thresholds, so the window is only the last
+        # common date.
+        models.SynopticTimeseriesGroup.objects.update(
+            last_early_warning_evaluation=None
+        )
+        with mock.patch(
+            "enhydris_synoptic.tail.read_tail", side_effect=tail.read_tail
+        ) as mock_read_tail:
+            check_early_warnings()
+        self.assertGreater(mock_read_tail.call_count, 0)
+        for args, _ in mock_read_tail.call_args_list:
+            timeseries, start_date, end_date, timezone = args
+            self.assertEqual(start_date, end_date)
+
+    def test_does_not_read_data_again_without_new_data(self):
+        with mock.patch(
+            "enhydris_synoptic.tail.read_tail", side_effect=tail.read_tail
+        ) as mock_read_tail:
+            check_early_warnings()
+        self.assertEqual(len(mail.outbox), 1)
+        mock_read_tail.assert_not_called()
+
+    def test_evaluates_again_after_limits_change(self):
+        self._set_limits(low_temperature=17.1, high_gust=3)
+        with mock.patch(
+            "enhydris_synoptic.tail.read_tail", side_effect=tail.read_tail
+        ) as mock_read_tail:
+            check_early_warnings()
+        self.assertGreater(mock_read_tail.call_count, 0)
+
+    def test_create_static_files_does_not_send_email_again(self):
+        create_static_files()
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_measurement(self):
+        children = self.result["children"]
+        self.assertEqual(children[0]["labels"], {"synoptic_group": "mygroup"})
+
+
+@override_settings(EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend")
+class SendEarlyWarningEmailsTestCase(ClearCacheMixin, TestCase):
+    def setUp(self):
+        self.data = TestData()
+        sg2 = mommy.make(
+            models.SynopticGroup,
+            slug="othergroup",
+            fresh_time_limit=dt.timedelta(minutes=60),
+        )
+        sgs = mommy.make(
+            models.SynopticGroupStation,
+            synoptic_group=sg2,
+            station=self.data.station_komboti,
+            order=1,
+        )
+        stsg = mommy.make(
+            models.SynopticTimeseriesGroup,
+            synoptic_group_station=sgs,
+            timeseries_group=self.data.tsg_komboti_temperature,
+            order=1,
+        )
+        for sgroup in (self.data.sg1, sg2):
+            models.EarlyWarningEmail.objects.create(
+                synoptic_group=sgroup, email="someone@blackhole.com"
+            )
+        self.summaries = [
+            self._get_summary(self.data.sg1.id, self.data.stsg1_2.id, "Komboti"),
+            {
+                # A synoptic group that has been deleted
+                "synoptic_group_id": 0,
+                "early_warning_evaluations": {},
+                "errors": [],
+            },
+            self._get_summary(sg2.id, stsg.id, "Komboti2"),
+        ]
+        with mock.patch(
+            "enhydris_synoptic.tasks.get_connection", wraps=get_connection
+        ) as self.mock_get_connection, self.assertLogs("enhydris_synoptic.tasks"):
+            self.result = send_early_warning_emails(self.summaries)
+
+    def _get_summary(self, synoptic_group_id, synoptic_timeseries_group_id, station):
+        return {
+            "synoptic_group_id": synoptic_group_id,
+            "errors": [],
+            "early_warning_evaluations": {
+                str(synoptic_timeseries_group_id): {
+                    "synoptic_timeseries_group": synoptic_timeseries_group_id,
+                    "date": "2015-10-22T15:20:00+02:00",
+                    "station": station,
+                    "variable": "Air temperature",
+                    "warnings": {"low": "2015-10-22 15:20 17.0 (low limit 17.1)"},
+                }
+            },
+        }
+
+    def test_sends_all_emails(self):
+        self.assertEqual(
+            [x.subject for x in mail.outbox],
+            [
+                "Enhydris early warning (Komboti)",
+                "Enhydris early warning (Komboti2)",
+            ],
+        )
+
+    def test_updates_states(self):
+        self.assertEqual(models.EarlyWarningState.objects.count(), 2)
+
+    def test_error(self):
+        self.assertEqual(len(self.result[1]["errors"]), 1)
+        self.assertEqual(self.result[0]["errors"], [])
+
+    def test_uses_single_connection(self):
+        self.assertEqual(self.mock_get_connection.call_count, 1)
+
+    def test_returns_summaries(self):
+        self.assertEqual(self.result, self.summaries)
+
+
 @RandomSynopticRoot()
 @override_settings(
     EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend",
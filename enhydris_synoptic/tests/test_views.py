@@ -0,0 +1,191 @@
+import datetime as dt
+import gzip
+import os
+from unittest import skipUnless
+
+from django.conf import settings
+from django.test import TestCase, override_settings
+
+import numpy as np
+from matplotlib.dates import AutoDateFormatter, date2num
+
+from enhydris_synoptic.views import (
+    ChartData,
+    ChartLine,
+    ChartPlot,
+    ChartRenderer,
+    File,
+    brotli,
+    downsample,
+    shutdown_chart_workers,
+)
+
+from .test_tasks import RandomSynopticRoot
+
+
+@RandomSynopticRoot()
+class FileTestCase(TestCase):
+    def setUp(self):
+        self.filename = os.path.join(settings.ENHYDRIS_SYNOPTIC_ROOT, "a", "b.html")
+        File("a/b.html").write("hello")
+        os.utime(self.filename, (1000000000, 1000000000))
+
+    def _read(self):
+        with open(self.filename, encoding="utf-8") as f:
+            return f.read()
+
+    def test_creates_directory_and_writes(self):
+        self.assertEqual(self._read(), "hello")
+
+    def test_overwrites(self):
+        File("a/b.html").write("hello")
+        self.assertNotEqual(os.path.getmtime(self.filename), 1000000000)
+
+    def test_only_if_changed_leaves_identical_file_alone(self):
+        result = File("a/b.html").write("hello", only_if_changed=True)
+        self.assertFalse(result)
+        self.assertEqual(os.path.getmtime(self.filename), 1000000000)
+
+    def test_only_if_changed_writes_changed_file(self):
+        result = File("a/b.html").write("hellp", only_if_changed=True)
+        self.assertTrue(result)
+        self.assertEqual(self._read(), "hellp")
+
+    def test_only_if_changed_writes_changed_bytes(self):
+        result = File("a/b.html").write(b"hello world", only_if_changed=True)
+        self.assertTrue(result)
+        self.assertEqual(self._read(), "hello world")
+
+    def test_only_if_changed_writes_new_file(self):
+        result = File("a/c.html").write("hello", only_if_changed=True)
+        self.assertTrue(result)
+
+
+@RandomSynopticRoot()
+@override_settings(ENHYDRIS_SYNOPTIC_PRECOMPRESS=True)
+class FilePrecompressTestCase(TestCase):
+    def setUp(self):
+        self.filename = os.path.join(settings.ENHYDRIS_SYNOPTIC_ROOT, "a", "b.html")
+        File("a/b.html").write("hello")
+
+    def test_gzip(self):
+        with gzip.open(self.filename + ".gz", "rt", encoding="utf-8") as f:
+            self.assertEqual(f.read(), "hello")
+
+    @skipUnless(brotli, "brotli is not installed")
+    def test_brotli(self):
+        with open(self.filename + ".br", "rb") as f:
+            self.assertEqual(brotli.decompress(f.read()), b"hello")
+
+    def test_bytes_are_not_compressed(self):
+        File("a/c.png").write(b"hello")
+        filename = os.path.join(settings.ENHYDRIS_SYNOPTIC_ROOT, "a", "c.png.gz")
+        self.assertFalse(os.path.exists(filename))
+
+    def test_unchanged_file_is_left_alone(self):
+        os.utime(self.filename + ".gz", (1000000000, 1000000000))
+        File("a/b.html").write("hello", only_if_changed=True)
+        self.assertEqual(os.path.getmtime(self.filename + ".gz"), 1000000000)
+
+    def test_changed_file(self):
+        File("a/b.html").write("world", only_if_changed=True)
+        with gzip.open(self.filename + ".gz", "rt", encoding="utf-8") as f:
+            self.assertEqual(f.read(), "world")
+
+    def test_missing_compressed_file_is_written(self):
+        os.remove(self.filename + ".gz")
+        File("a/b.html").write("hello", only_if_changed=True)
+        self.assertTrue(os.path.exists(self.filename + ".gz"))
+
+    def test_compressed_file_is_removed_when_precompression_is_off(self):
+        with override_settings(ENHYDRIS_SYNOPTIC_PRECOMPRESS=False):
+            File("a/b.html").write("world")
+        self.assertFalse(os.path.exists(self.filename + ".gz"))
+
+
+@RandomSynopticRoot()
+class ChartPlotFigureReuseTestCase(TestCase):
+    def _get_chart_data(self, id, values, label="", other_values=None):
+        start = dt.datetime(2015, 10, 22, 15, 0)
+        xdata = date2num([start + dt.timedelta(minutes=10 * i) for i in range(6)])
+        lines = [ChartLine(xdata=xdata, ydata=np.array(values), label=label)]
+        if other_values:
+            lines.append(ChartLine(xdata=xdata, ydata=np.array(other_values), label=""))
+        return ChartData(
+            id=id, lines=lines, default_chart_min=None, default_chart_max=None
+        )
+
+    def _render_and_read(self, chart_data):
+        ChartPlot(chart_data).render()
+        filename = os.path.join(
+            settings.ENHYDRIS_SYNOPTIC_ROOT, "chart", f"{chart_data.id}.png"
+        )
+        with open(filename, "rb") as f:
+            return f.read()
+
+    def test_previous_chart_does_not_affect_next_one(self):
+        chart_data = self._get_chart_data(1, [1, 2, 3, 2, 1, 0])
+        first_result = self._render_and_read(chart_data)
+        self._render_and_read(
+            self._get_chart_data(
+                2, [8, 9, 1, 2, 1, 9], label="x", other_values=[1, 2, 1, 2, 1, 2]
+            )
+        )
+        self.assertEqual(self._render_and_read(chart_data), first_result)
+
+
+@RandomSynopticRoot()
+@override_settings(ENHYDRIS_SYNOPTIC_CHART_WORKERS=2)
+class ChartRendererWorkersTestCase(TestCase):
+    def setUp(self):
+        self.addCleanup(shutdown_chart_workers)
+
+    def test_workers_are_reused(self):
+        with ChartRenderer() as chart_renderer:
+            executor = chart_renderer.executor
+        with ChartRenderer() as chart_renderer:
+            self.assertIs(chart_renderer.executor, executor)
+
+    def test_workers_are_started_again_after_shutdown(self):
+        with ChartRenderer() as chart_renderer:
+            executor = chart_renderer.executor
+        shutdown_chart_workers()
+        with ChartRenderer() as chart_renderer:
+            self.assertIsNotNone(chart_renderer.executor)
+            self.assertIsNot(chart_renderer.executor, executor)
+
+    def test_no_workers_when_zero(self):
+        with ChartRenderer(workers=0) as chart_renderer:
+            self.assertIsNone(chart_renderer.executor)
+
+
+class ChartPlotEmptyTestCase(TestCase):
+    def test_empty_chart_has_no_date_axis(self):
+        line = ChartLine(xdata=np.array([]), ydata=np.array([]), label="")
+        chart_data = ChartData(
+            id=1, lines=[line], default_chart_min=None, default_chart_max=None
+        )
+        chart_plot = ChartPlot(chart_data)
+        chart_plot.get_png()
+        self.assertNotIsInstance(
+            chart_plot.ax.xaxis.get_major_formatter(), AutoDateFormatter
+        )
+
+
+class DownsampleTestCase(TestCase):
+    def setUp(self):
+        self.xdata = np.arange(20.0)
+        self.ydata = np.array(
+            [5, 1, 9, 3, 4, 4, 2, 8, 7, 7, 0, 6, 6, 1, 3, np.nan, 2, 2, 5, 4],
+            dtype=float,
+        )
+
+    def test_short_line_is_unchanged(self):
+        xdata, ydata = downsample(self.xdata, self.ydata, 10)
+        np.testing.assert_array_equal(xdata, self.xdata)
+        np.testing.assert_array_equal(ydata, self.ydata)
+
+    def test_minimum_and_maximum_of_each_column_are_kept(self):
+        xdata, ydata = downsample(self.xdata, self.ydata, 4)
+        np.testing.assert_array_equal(xdata, [0, 1, 2, 6, 7, 10, 12, 15, 16, 18, 19])
+        np.testing.assert_array_equal(ydata, [5, 1, 9, 2, 8, 0, 6, np.nan, 2, 5, 4])
@@ -0,0 +1,21 @@
+from django.urls import path
+
+from . import live
+
+app_name = "enhydris_synoptic"
+
+urlpatterns = [
+    path("chart/<int:synoptic_timeseries_group_id>.png", live.chart, name="chart"),
+    path("<slug:slug>/", live.synoptic_group_page, name="synoptic_group"),
+    path("<slug:slug>/stations.json", live.map_stations, name="map_stations"),
+    path(
+        "<slug:slug>/station/<int:station_id>/",
+        live.station_page,
+        name="station",
+    ),
+    path(
+        "<slug:slug>/station/<int:station_id>/charts.json",
+        live.station_charts,
+        name="station_charts",
+    ),
+]
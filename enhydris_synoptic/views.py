@@ -5,15 +5,30 @@ uses celery to render its output to static files. So this file contains function
 to do such offline rendering. It doesn't know about requests and responses, and it
 doesn't know about HTTP. But logically it's the "views" part of a Django app.
 """
+import gzip
+import hashlib
+import json
 import math
+import multiprocessing
 import os
+import threading
+from collections import namedtuple
+from concurrent import futures
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from io import BytesIO
 
 from django.conf import settings
 from django.contrib.gis.db.models import Extent
 from django.http import HttpRequest
+from django.template.defaultfilters import floatformat, truncatechars
 from django.template.loader import render_to_string
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 import matplotlib
 
 # We have to execute matplotlib.use() after the matplotlib import and before the rest of
@@ -23,10 +38,15 @@ import matplotlib
 matplotlib.use("AGG")  # NOQA
 
 import enhydris.context_processors  # NOQA
-import matplotlib.pyplot as plt  # NOQA
+import numpy as np  # NOQA
 import pandas.plotting  # NOQA
 from enhydris.views_common import ensure_extent_is_large_enough  # NOQA
-from matplotlib.dates import DateFormatter, DayLocator, HourLocator  # NOQA
+from matplotlib.backends.backend_agg import FigureCanvasAgg  # NOQA
+from matplotlib.dates import DateFormatter, DayLocator, HourLocator, date2num  # NOQA
+from matplotlib.figure import Figure  # NOQA
+
+from . import chart_workers  # NOQA
+from .instrumentation import add_bytes_written, add_result, measure  # NOQA
 
 pandas.plotting.register_matplotlib_converters()
 
@@ -39,6 +59,19 @@ class File:
     relative_filename. Directories are automatically created. The file is written
     atomically; so if many processes attempt to write to it at the same time, only one
     will win (i.e. the file will not be corrupt).
+
+    If write() is called with only_if_changed=True, the file is left alone (so that
+    its modification time, and therefore its ETag, does not change) if it already
+    has the same content. write() returns True if it wrote the file and False if it
+    left it alone.
+
+    If ENHYDRIS_SYNOPTIC_PRECOMPRESS is True, text files (i.e. when s is a string)
+    are also written compressed, with gzip to a ".gz" file and, if the "brotli"
+    module is installed, with brotli to a ".br" file, so that the web server can
+    serve them without compressing them on each request. These compressed files are
+    written before the uncompressed one and, like it, atomically.
+
+    The number of bytes written is reported to the instrumentation.
     """
 
     def __init__(self, relative_filename):
@@ -47,67 +80,277 @@ class File:
             settings.ENHYDRIS_SYNOPTIC_ROOT, relative_filename
         )
 
-    def write(self, s):
+    def write(self, s, only_if_changed=False):
+        compressed_versions = self._get_compressed_versions(s)
+        if (
+            only_if_changed
+            and not self._content_differs(s)
+            and all(os.path.exists(x) for x in compressed_versions)
+        ):
+            return False
         self._ensure_directory_exists()
-        self._write_to_temporary_file(s)
-        self._atomically_replace_final_file()
+        for pathname, compress in compressed_versions.items():
+            content = compress(s.encode("utf-8"))
+            self._write_atomically(pathname, content)
+            add_bytes_written(len(content))
+        self._remove_stale_compressed_versions(compressed_versions)
+        self._write_atomically(self.full_pathname, s)
+        add_bytes_written(len(s if isinstance(s, bytes) else s.encode("utf-8")))
+        return True
+
+    def _get_compressed_versions(self, s):
+        result = {}
+        if isinstance(s, bytes) or not getattr(
+            settings, "ENHYDRIS_SYNOPTIC_PRECOMPRESS", False
+        ):
+            return result
+        result[self.full_pathname + ".gz"] = _gzip_compress
+        if brotli is not None:
+            result[self.full_pathname + ".br"] = brotli.compress
+        return result
+
+    def _remove_stale_compressed_versions(self, compressed_versions):
+        # If precompression has been switched off (or brotli uninstalled) since the
+        # last time, the compressed files left over would have the old content.
+        for pathname in (self.full_pathname + ".gz", self.full_pathname + ".br"):
+            if pathname not in compressed_versions and os.path.exists(pathname):
+                os.remove(pathname)
+
+    def _content_differs(self, s):
+        content = s if isinstance(s, bytes) else s.encode("utf-8")
+        try:
+            if os.path.getsize(self.full_pathname) != len(content):
+                return True
+            with open(self.full_pathname, "rb") as f:
+                existing_hash = hashlib.sha256(f.read()).digest()
+        except FileNotFoundError:
+            return True
+        return hashlib.sha256(content).digest() != existing_hash
 
     def _ensure_directory_exists(self):
         dirname = os.path.dirname(self.full_pathname)
         if not os.path.exists(dirname):
             os.makedirs(dirname)
 
-    def _write_to_temporary_file(self, s):
-        self.temporary_full_pathname = self.full_pathname + ".1"
+    def _write_atomically(self, pathname, s):
+        temporary_pathname = pathname + ".1"
         mode = "wb" if isinstance(s, bytes) else "w"
         encoding = None if isinstance(s, bytes) else "utf-8"
-        with open(self.temporary_full_pathname, mode, encoding=encoding) as f:
+        with open(temporary_pathname, mode, encoding=encoding) as f:
             f.write(s)
+        os.replace(temporary_pathname, pathname)
+
+
+def _gzip_compress(content):
+    # mtime=0 so that the same content always gives the same compressed file
+    return gzip.compress(content, compresslevel=9, mtime=0)
 
-    def _atomically_replace_final_file(self):
-        os.replace(self.temporary_full_pathname, self.full_pathname)
 
+def render_synoptic_station(synstation, chart_renderer=None):
+    """Render the page and charts of a station, unless they are up to date.
 
-def render_synoptic_station(synstation):
-    _check_for_null_values(synstation)
-    _render_station_page(synstation)
-    _render_station_charts(synstation)
+    The station is skipped if its fingerprint is the same as when it was last
+    rendered (and its page is still there). Returns the entry of the station in
+    stations.json (see render_map_stations()); for a skipped station, this is the
+    entry stored when it was last rendered, so its data is not read at all.
+    """
+    with measure(
+        "station",
+        synoptic_group=synstation.synoptic_group.slug,
+        station=synstation.station.id,
+    ):
+        with measure("fingerprint"):
+            fingerprint = synstation.fingerprint
+        if _is_up_to_date(synstation, fingerprint):
+            return json.loads(synstation.rendering_map_station)
+        with measure("data"):
+            synstation.synoptic_timeseries_groups  # Reads the data, checks the values
+        with measure("map_station"):
+            map_station = get_map_station(synstation)
+        with measure("page"):
+            _render_station_page(synstation)
+        with measure("charts"):
+            _render_station_charts(synstation, chart_renderer, fingerprint, map_station)
+        return map_station
+
+
+def _is_up_to_date(synstation, fingerprint):
+    return (
+        fingerprint == synstation.rendering_fingerprint
+        and synstation.rendering_map_station
+        and os.path.exists(File(_get_station_page_filename(synstation)).full_pathname)
+    )
 
 
-def _check_for_null_values(synstation):
-    for syntsg in synstation.synoptic_timeseries_groups:
-        syntsg.value_is_null = math.isnan(getattr(syntsg, "value", float("NaN")))
+def _render_station_charts(synstation, chart_renderer, fingerprint, map_station):
+    if _get_chart_backend() == "json":
+        _render_station_charts_json(synstation)
+        synstation.save_rendering_fingerprint(fingerprint, map_station)
+    elif chart_renderer is None:
+        # Worker processes aren't worth it for the few charts of a single station
+        with ChartRenderer(workers=0) as chart_renderer:
+            _render_station_png_charts(
+                synstation, chart_renderer, fingerprint, map_station
+            )
+    else:
+        _render_station_png_charts(synstation, chart_renderer, fingerprint, map_station)
+
+
+def _get_chart_backend():
+    return getattr(settings, "ENHYDRIS_SYNOPTIC_CHART_BACKEND", "png")
 
 
 def _render_station_page(synstation):
-    output = render_to_string(
-        "enhydris-synoptic/groupstation.html", context={"object": synstation}
+    output = get_station_page(synstation)
+    File(_get_station_page_filename(synstation)).write(output, only_if_changed=True)
+
+
+def get_station_page(synstation):
+    """Return the HTML of the page of a station."""
+    return render_to_string(
+        "enhydris-synoptic/groupstation.html",
+        context={"object": synstation, "chart_backend": _get_chart_backend()},
     )
-    filename = os.path.join(
+
+
+def _get_station_page_filename(synstation):
+    return os.path.join(
         synstation.synoptic_group.slug,
         "station",
         str(synstation.station.id),
         "index.html",
     )
-    File(filename).write(output)
 
 
-def _render_station_charts(synstation):
+def _render_station_png_charts(synstation, chart_renderer, fingerprint, map_station):
     for t in synstation.synoptic_timeseries_groups:
-        Chart(t, synstation.synoptic_timeseries_groups).render()
+        chart_renderer.render(Chart(t, synstation.synoptic_timeseries_groups))
+    chart_renderer.call_when_done(
+        synstation.save_rendering_fingerprint, fingerprint, map_station
+    )
+
+
+def _render_station_charts_json(synstation):
+    filename = os.path.join(
+        os.path.dirname(_get_station_page_filename(synstation)), "charts.json"
+    )
+    File(filename).write(get_station_charts(synstation), only_if_changed=True)
+
+
+def get_station_charts(synstation):
+    """Return the charts.json of a station.
+
+    This is used instead of the PNG charts if ENHYDRIS_SYNOPTIC_CHART_BACKEND is
+    "json"; the station page then fetches it and draws the charts in the browser. It
+    contains the same data as the ChartData objects of the charts of the station
+    (except that the x data are seconds since the epoch), for the charts that the
+    station page shows (i.e. not for the synoptic time series groups that are grouped
+    with another).
+    """
+    asyntsgs = synstation.synoptic_timeseries_groups
+    charts = [
+        _get_chart_json(Chart(x, asyntsgs).get_chart_data())
+        for x in asyntsgs
+        if x.group_with_id is None
+    ]
+    return json.dumps({"charts": charts}, ensure_ascii=False, separators=(",", ":"))
+
+
+def _get_chart_json(chart_data):
+    return {
+        "id": chart_data.id,
+        "lines": [
+            {
+                "label": line.label,
+                "x": _get_epoch_seconds(line.xdata),
+                "y": [None if math.isnan(y) else y for y in line.ydata.tolist()],
+            }
+            for line in chart_data.lines
+        ],
+        "default_chart_min": chart_data.default_chart_min,
+        "default_chart_max": chart_data.default_chart_max,
+    }
+
+
+def _get_epoch_seconds(date_numbers):
+    epoch = date2num(np.datetime64("1970-01-01T00:00"))
+    return np.rint((np.asarray(date_numbers) - epoch) * 86400).astype(int).tolist()
 
 
 def render_synoptic_group(synoptic_group):
-    _render_only_group(synoptic_group)
-    _render_group_stations(synoptic_group)
-    synoptic_group.send_early_warning_emails()
+    with measure("synoptic_group", synoptic_group=synoptic_group.slug):
+        render_synoptic_group_page(synoptic_group)
+        map_stations = render_synoptic_group_stations(synoptic_group)
+        render_map_stations(synoptic_group, map_stations)
+        with measure("early_warning_emails"):
+            synoptic_group.send_early_warning_emails()
+
+
+def render_synoptic_group_page(synoptic_group):
+    """Render the map page of a synoptic group.
+
+    The page itself does not contain the stations and their last values, which
+    change in every cycle; these are written to "stations.json" by
+    render_map_stations(), and the page fetches them. So the page usually remains
+    unchanged, and rendering it does not need the data of the stations.
+    """
+    with measure("group_page"):
+        output = get_synoptic_group_page(synoptic_group)
+        filename = os.path.join(synoptic_group.slug, "index.html")
+        File(filename).write(output, only_if_changed=True)
+
 
+def render_map_stations(synoptic_group, map_stations):
+    """Write the stations.json of a synoptic group.
+
+    "map_stations" is the list of the entries of the stations, as returned by
+    render_synoptic_station(). They are produced while rendering the stations (which
+    may be done by many tasks), so that the data of each station is read only once.
+    """
+    with measure("map_stations"):
+        output = _dump_map_stations(map_stations)
+        filename = os.path.join(synoptic_group.slug, "stations.json")
+        File(filename).write(output, only_if_changed=True)
 
-def _render_only_group(synoptic_group):
+
+def get_synoptic_group_page(synoptic_group):
+    """Return the HTML of the map page of a synoptic group."""
     context = {"object": synoptic_group, **_get_map_context(synoptic_group)}
-    output = render_to_string("enhydris-synoptic/group.html", context=context)
-    filename = os.path.join(synoptic_group.slug, "index.html")
-    File(filename).write(output)
+    return render_to_string("enhydris-synoptic/group.html", context=context)
+
+
+def get_map_stations(synoptic_group):
+    """Return the stations.json of a synoptic group."""
+    return _dump_map_stations(
+        [get_map_station(x) for x in synoptic_group.synoptic_group_stations]
+    )
+
+
+def _dump_map_stations(map_stations):
+    return json.dumps(map_stations, ensure_ascii=False, separators=(",", ":"))
+
+
+def get_map_station(synstation):
+    """Return the entry of a station in stations.json, as a dict."""
+    syntsgs = synstation.synoptic_timeseries_groups
+    return {
+        "id": synstation.id,
+        "name": truncatechars(synstation.station.name, 13),
+        "target_url": synstation.target_url,
+        "latitude": synstation.station.geom.y,
+        "longitude": synstation.station.geom.x,
+        "last_common_date_pretty_without_timezone": (
+            synstation.last_common_date_pretty_without_timezone or ""
+        ),
+        "freshness": synstation.freshness,
+        "last_values": {x.full_name: _get_formatted_value(x) for x in syntsgs},
+        "last_values_status": {x.full_name: x.value_status for x in syntsgs},
+    }
+
+
+def _get_formatted_value(syntsg):
+    value = floatformat(syntsg.value, syntsg.precision or 0)
+    return f"{value} {syntsg.unit_symbol}"
 
 
 def _get_map_context(sgroup):
@@ -125,9 +368,146 @@ def _get_bounding_box(sgroup):
     return extent
 
 
-def _render_group_stations(synoptic_group):
-    for synstation in synoptic_group.synopticgroupstation_set.all():
-        render_synoptic_station(synstation)
+def render_synoptic_group_stations(synoptic_group, synoptic_group_station_ids=None):
+    """Render the station pages and charts of a synoptic group.
+
+    If synoptic_group_station_ids is specified, only these stations are rendered.
+    Returns the list of the entries of the rendered stations in stations.json (see
+    render_map_stations()).
+    """
+    map_stations = []
+    with measure("stations"), ChartRenderer() as chart_renderer:
+        for synstation in synoptic_group.synoptic_group_stations:
+            if synoptic_group_station_ids is None or (
+                synstation.id in synoptic_group_station_ids
+            ):
+                map_stations.append(render_synoptic_station(synstation, chart_renderer))
+    return map_stations
+
+
+class ChartRenderer:
+    """Render charts, optionally using a pool of worker processes.
+
+    Use it as a context manager:
+
+        with ChartRenderer() as chart_renderer:
+            chart_renderer.render(chart)
+
+    If ENHYDRIS_SYNOPTIC_CHART_WORKERS (or "workers", if specified) is a positive
+    number, the charts are plotted in that many worker processes; otherwise they are
+    plotted in the current process, one after the other. Only the plotting inputs (a
+    ChartData object) are sent to the worker processes, which write the PNG files
+    themselves. The worker processes are started the first time they are needed and
+    are reused by all later ChartRenderer objects of the process, until
+    shutdown_chart_workers() is called. In any case, all charts have been written when
+    the "with" block exits; functions registered with call_when_done() are then
+    called, unless some chart failed. The measurements of the charts plotted by the
+    worker processes are added to the block that is being measured when the "with"
+    block exits.
+    """
+
+    def __init__(self, workers=None):
+        if workers is None:
+            workers = getattr(settings, "ENHYDRIS_SYNOPTIC_CHART_WORKERS", 0)
+        self.workers = workers
+
+    def __enter__(self):
+        self.executor = _get_chart_executor(self.workers) if self.workers else None
+        self.futures = []
+        self.callbacks = []
+        return self
+
+    def render(self, chart):
+        if self.executor is None:
+            chart.render()
+        else:
+            future = self.executor.submit(_plot_chart, chart.get_chart_data())
+            self.futures.append(future)
+
+    def call_when_done(self, func, *args):
+        self.callbacks.append((func, args))
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            for future in self.futures:
+                future.cancel()
+        futures.wait(self.futures)
+        if exc_type is not None:
+            if issubclass(exc_type, BrokenProcessPool):
+                _discard_chart_executor(self.executor)
+            # Let the original exception propagate, rather than one from a worker
+            return
+        try:
+            for future in self.futures:
+                # This re-raises any exception raised in the worker
+                add_result(future.result())
+        except BrokenProcessPool:
+            # A worker process died; new ones will be started next time
+            _discard_chart_executor(self.executor)
+            raise
+        for func, args in self.callbacks:
+            func(*args)
+
+
+# The pool of the worker processes that plot the charts (see ChartRenderer). Starting
+# the workers costs more than plotting the charts of a few stations, so the pool is
+# shared by all tasks of the process. It is started again if the settings that the
+# workers receive change (see chart_workers.get_settings()).
+_chart_executor = None
+_chart_executor_key = None
+_chart_executor_lock = threading.Lock()
+
+
+def _get_chart_executor(workers):
+    global _chart_executor, _chart_executor_key
+    worker_settings = chart_workers.get_settings()
+    key = (workers, worker_settings)
+    with _chart_executor_lock:
+        if _chart_executor is not None and _chart_executor_key != key:
+            _chart_executor.shutdown(wait=True)
+            _chart_executor = None
+        if _chart_executor is None:
+            # See the "chart_workers" module for why the workers aren't simply forked
+            mp_context = multiprocessing.get_context("forkserver")
+            mp_context.set_forkserver_preload(chart_workers.PRELOADED_MODULES)
+            _chart_executor = ProcessPoolExecutor(
+                workers,
+                mp_context=mp_context,
+                initializer=chart_workers.initialize,
+                initargs=(worker_settings,),
+            )
+            _chart_executor_key = key
+        return _chart_executor
+
+
+def _discard_chart_executor(executor):
+    global _chart_executor, _chart_executor_key
+    with _chart_executor_lock:
+        if executor is _chart_executor:
+            _chart_executor = _chart_executor_key = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def shutdown_chart_workers():
+    """Stop the worker processes that plot the charts, if they have been started."""
+    global _chart_executor, _chart_executor_key
+    with _chart_executor_lock:
+        if _chart_executor is not None:
+            _chart_executor.shutdown(wait=True)
+        _chart_executor = _chart_executor_key = None
+
+
+def _plot_chart(chart_data):
+    with measure("chart") as measurement:
+        ChartPlot(chart_data).render()
+    return measurement.result
+
+
+# xdata are matplotlib date numbers (see matplotlib.dates.date2num()).
+ChartLine = namedtuple("ChartLine", ["xdata", "ydata", "label"])
+ChartData = namedtuple(
+    "ChartData", ["id", "lines", "default_chart_min", "default_chart_max"]
+)
 
 
 class Chart:
@@ -136,81 +516,182 @@ class Chart:
         self.all_synoptic_timeseries_groups = all_synoptic_timeseries_groups
 
     def render(self):
+        with measure("chart"):
+            with measure("chart_data"):
+                chart_data = self.get_chart_data()
+            ChartPlot(chart_data).render()
+
+    def get_chart_data(self):
+        """Return the inputs needed to plot the chart as a ChartData object.
+
+        The result contains only plain data (no model instances), so that it can be
+        sent to another process.
+        """
         self._get_all_groupped_timeseries_groups()
         self._reorder_groupped_timeseries_groups()
-        self._setup_plot()
-        self._draw_lines()
-        if len(self.xdata):
-            self._change_plot_limits()
-            self._fill()
-            self._set_x_ticks_and_labels()
-            self._set_gridlines_and_legend()
-        self._create_and_save_plot()
-        self._write_data_to_file_for_unit_testing()
+        return ChartData(
+            id=self.current_synoptic_timeseries_group.id,
+            lines=[self._get_chart_line(x) for x in self._synoptic_timeseries_groups],
+            default_chart_min=self.current_synoptic_timeseries_group.default_chart_min,
+            default_chart_max=self.current_synoptic_timeseries_group.default_chart_max,
+        )
 
     def _get_all_groupped_timeseries_groups(self):
         self._synoptic_timeseries_groups = [
             x
             for x in self.all_synoptic_timeseries_groups
             if (x.id == self.current_synoptic_timeseries_group.id)
-            or (
-                x.group_with
-                and x.group_with.id == self.current_synoptic_timeseries_group.id
-            )
+            or (x.group_with_id == self.current_synoptic_timeseries_group.id)
         ]
 
     def _reorder_groupped_timeseries_groups(self):
         self._synoptic_timeseries_groups.sort(
-            key=lambda x: float(x.data.value.sum()), reverse=True
+            key=lambda x: float(np.nansum(x.values)), reverse=True
         )
 
-    def _setup_plot(self):
-        self.fig = plt.figure()
-        self.fig.set_dpi(100)
-        self.fig.set_size_inches(3.2, 2)
-        self.fig.subplots_adjust(left=0.10, right=0.99, bottom=0.15, top=0.97)
+    def _get_chart_line(self, synts):
+        # The timestamps are naive UTC, so the chart shows UTC, as date2num() does
+        # with aware datetimes
+        xdata = date2num(synts.timestamps)
+        ydata = synts.values
+        if getattr(settings, "ENHYDRIS_SYNOPTIC_CHART_DOWNSAMPLING", True):
+            xdata, ydata = downsample(xdata, ydata, CHART_PLOT_WIDTH)
+        return ChartLine(xdata=xdata, ydata=ydata, label=synts.chart_label)
+
+
+def downsample(xdata, ydata, columns):
+    """Reduce the points of a line to those that are visible when plotted.
+
+    The x range of the line is divided into "columns" equal parts (normally one per
+    pixel column of the plot), and only the points with the minimum and maximum y of
+    each part are kept (plus the first and last point of the line, and the first
+    null value of each part, so that gaps are still shown). Drawing the result looks
+    the same as drawing the whole line. xdata must be sorted. If there are no more
+    than 2 * columns points, the line is returned unchanged.
+    """
+    xdata = np.asarray(xdata, dtype=float)
+    ydata = np.asarray(ydata, dtype=float)
+    if len(xdata) <= 2 * columns or xdata[-1] <= xdata[0]:
+        return xdata, ydata
+    scale = columns / (xdata[-1] - xdata[0])
+    column_of_point = ((xdata - xdata[0]) * scale).astype(int)
+    np.minimum(column_of_point, columns - 1, out=column_of_point)
+    column_starts = np.flatnonzero(np.diff(column_of_point)) + 1
+    column_ends = np.append(column_starts, len(xdata)) - 1
+    column_starts = np.insert(column_starts, 0, 0)
+    is_null = np.isnan(ydata)
+    by_min = np.lexsort((np.where(is_null, np.inf, ydata), column_of_point))
+    by_max = np.lexsort((np.where(is_null, -np.inf, ydata), column_of_point))
+    null_points = np.flatnonzero(is_null)
+    first_null_points = null_points[
+        np.diff(column_of_point[null_points], prepend=-1) != 0
+    ]
+    keep = np.unique(
+        np.concatenate(
+            (
+                [0, len(xdata) - 1],
+                by_min[column_starts],
+                by_max[column_ends],
+                first_null_points,
+            )
+        )
+    )
+    return xdata[keep], ydata[keep]
+
+
+_CHART_DPI = 100
+_CHART_SIZE = (3.2, 2)
+_CHART_LEFT, _CHART_RIGHT = 0.10, 0.99
+
+# The width of the plotting area of the charts in pixels
+CHART_PLOT_WIDTH = round(_CHART_SIZE[0] * _CHART_DPI * (_CHART_RIGHT - _CHART_LEFT))
+
+_chart_figures = threading.local()
+
+
+def _get_chart_figure():
+    """Return the chart figure and axes of the current thread.
+
+    Creating a figure is a large part of the time needed to plot a chart, so each
+    process (or thread) creates one figure, with one axes, the first time it needs
+    it, and reuses it for all charts. The figure is not created through pyplot, so it
+    is not registered with pyplot's global figure manager and it is never closed.
+    """
+    if not hasattr(_chart_figures, "figure"):
         matplotlib.rcParams.update({"font.size": 7})
-        self.ax = self.fig.add_subplot(1, 1, 1)
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        fig.set_dpi(_CHART_DPI)
+        fig.set_size_inches(*_CHART_SIZE)
+        fig.subplots_adjust(left=_CHART_LEFT, right=_CHART_RIGHT, bottom=0.15, top=0.97)
+        _chart_figures.figure = fig
+        _chart_figures.axes = fig.add_subplot(1, 1, 1)
+    return _chart_figures.figure, _chart_figures.axes
+
+
+class ChartPlot:
+    """Plot a chart from a ChartData object.
+
+    render() saves it to a PNG file; get_png() returns the PNG image.
+    """
+
+    def __init__(self, chart_data):
+        self.chart_data = chart_data
+
+    def render(self):
+        filename = os.path.join("chart", str(self.chart_data.id) + ".png")
+        File(filename).write(self.get_png(), only_if_changed=True)
+        self._write_data_to_file_for_unit_testing()
+
+    def get_png(self):
+        self._setup_plot()
+        self._draw_lines()
+        if len(self.xdata):
+            self._change_plot_limits()
+            self._fill()
+            self._set_x_ticks_and_labels()
+            self._set_gridlines_and_legend()
+        return self._get_png_image()
+
+    def _setup_plot(self):
+        self.fig, self.ax = _get_chart_figure()
+        self.ax.clear()
 
     def _draw_lines(self):
-        for i, s in enumerate(self._synoptic_timeseries_groups):
-            if len(s.data) <= 1:
+        for i, line in enumerate(self.chart_data.lines):
+            if len(line.xdata) <= 1:
                 self._set_chart_empty()
             else:
-                self._plot_line(i, s)
+                self._plot_line(i, line)
             if i == 0:
                 # We will later need the data of the first time series, in
                 # order to fill the chart
+                self.gxdata = self.xdata
                 self.gydata = self.ydata
 
     def _set_chart_empty(self):
         self.xdata = self.ydata = []
 
-    def _plot_line(self, i, synts):
+    def _plot_line(self, i, line):
         # We use matplotlib's plot() instead of pandas's wrapper, because otherwise
         # there is trouble modifying the x axis labels (see
         # http://stackoverflow.com/questions/12945971/).
-        self.xdata = synts.data.index.to_pydatetime()
-        self.ydata = synts.data["value"]
-        self.ax.plot(
-            self.xdata, self.ydata, color=self._get_color(i), label=synts.get_subtitle()
-        )
+        self.xdata = line.xdata
+        self.ydata = line.ydata
+        self.ax.xaxis_date()
+        self.ax.plot(self.xdata, self.ydata, color=self._get_color(i), label=line.label)
 
     def _change_plot_limits(self):
         self.ax.set_xlim(self.xdata[0], self.xdata[-1])
         self.xmin, self.xmax, self.ymin, self.ymax = self.ax.axis()
-        if self.current_synoptic_timeseries_group.default_chart_min:
-            self.ymin = min(
-                self.current_synoptic_timeseries_group.default_chart_min, self.ymin
-            )
-        if self.current_synoptic_timeseries_group.default_chart_max:
-            self.ymax = max(
-                self.current_synoptic_timeseries_group.default_chart_max, self.ymax
-            )
+        if self.chart_data.default_chart_min:
+            self.ymin = min(self.chart_data.default_chart_min, self.ymin)
+        if self.chart_data.default_chart_max:
+            self.ymax = max(self.chart_data.default_chart_max, self.ymax)
         self.ax.set_ylim([self.ymin, self.ymax])
 
     def _fill(self):
-        self.ax.fill_between(self.xdata, self.gydata, self.ymin, color="#ffff00")
+        self.ax.fill_between(self.gxdata, self.gydata, self.ymin, color="#ffff00")
 
     def _set_x_ticks_and_labels(self):
         self.ax.xaxis.set_minor_locator(HourLocator(byhour=range(0, 24, 3)))
@@ -222,24 +703,17 @@ class Chart:
 
     def _set_gridlines_and_legend(self):
         self.ax.grid(b=True, which="both", color="b", linestyle=":")
-        if len(self._synoptic_timeseries_groups) > 1:
+        if len(self.chart_data.lines) > 1:
             self.ax.legend()
 
-    def _create_and_save_plot(self):
-        f = BytesIO()
-        self.fig.savefig(f)
-        plt.close(self.fig)  # Release some memory
-        filename = os.path.join(
-            "chart", str(self.current_synoptic_timeseries_group.id) + ".png"
-        )
-        File(filename).write(f.getvalue())
-        f.close()
+    def _get_png_image(self):
+        with BytesIO() as f:
+            self.fig.savefig(f)
+            return f.getvalue()
 
     def _write_data_to_file_for_unit_testing(self):
         if hasattr(settings, "TEST_MATPLOTLIB") and settings.TEST_MATPLOTLIB:
-            filename = os.path.join(
-                "chart", str(self.current_synoptic_timeseries_group.id) + ".dat"
-            )
+            filename = os.path.join("chart", str(self.chart_data.id) + ".dat")
             data = [
                 repr(line.get_xydata()).replace("\n", " ") for line in self.ax.lines
             ]